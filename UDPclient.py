@@ -1,61 +1,1632 @@
+import argparse
 import socket
 import sys
 import os
 import base64
+import binascii
+import hashlib
+import json
+import logging
 import time
 import math
+import random
+import struct
+import threading
+import zlib
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration ---
-CHUNK_SIZE = 1000       # Bytes of raw data expected per chunk
+CHUNK_SIZE = 1000       # Bytes of raw data per chunk of the legacy protocol
+DEFAULT_CHUNK_SIZE = 60000 # Chunk size proposed with 'CHUNK' (the server may clamp it)
+MAX_CHUNK_SIZE = 65000  # Largest binary chunk: header + payload must fit a 65507-byte UDP datagram
+RECV_BUFFER_SIZE = 65536 # recvfrom() size, enough for any UDP datagram
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024 # Most SO_RCVBUF asked for on a data socket (the kernel may clamp it)
+DATAGRAM_OVERHEAD = 1024 # Kernel bookkeeping per queued datagram, counted against SO_RCVBUF
+IP_UDP_HEADER_SIZE = 28 # IPv4 + UDP headers, subtracted from the path MTU
+TEXT_DATA_OVERHEAD = 400 # Room for "DATA <filename> START .. END .. CRC .." in front of base64 data
+IP_MTU = getattr(socket, 'IP_MTU', 14) # Linux socket option; not exported by every Python build
 MAX_RETRIES = 5         # Max retransmission attempts for a chunk
 INITIAL_TIMEOUT = 1.0   # Initial timeout for stop-and-wait (seconds)
 TIMEOUT_MULTIPLIER = 2  # Multiplier for exponential backoff
+MIN_RTO = 0.02          # Lower bound on the adaptive retransmission timeout (seconds)
+MAX_RTO = 16.0          # Upper bound on the adaptive retransmission timeout (seconds)
+RTO_GRANULARITY = 0.01  # Minimum margin over SRTT, absorbs timer and scheduling jitter (seconds)
+RTT_ALPHA = 0.125       # Gain for the smoothed RTT (RFC 6298)
+RTT_BETA = 0.25         # Gain for the RTT variance (RFC 6298)
+INITIAL_CWND = 4        # Chunk requests in flight when a windowed transfer starts
+MIN_CWND = 2            # The congestion window never shrinks below this
+NEGOTIATION_RETRIES = 3 # Attempts for an extended DOWNLOAD before falling back to the legacy request
+BUSY_WAIT_LIMIT = 120.0 # Longest time to keep asking a server that answers BUSY (seconds)
+MAX_BUSY_DELAY = 10.0   # Upper bound on the pause between two attempts at a BUSY server (seconds)
+MIN_STRIPE_SIZE = 1024 * 1024 # Files are striped only into parts of at least this many bytes
+DEFAULT_WINDOW = 32     # Chunk requests kept in flight by the windowed protocol (1 = legacy stop-and-wait)
+MANY_BATCH_FILES = 128  # Most files named in one DOWNLOAD_MANY request
+MANY_REQUEST_LIMIT = 16384 # Most bytes of file names in one DOWNLOAD_MANY request
 CLIENT_FILES_DIR = 'client_files' # Directory where downloaded files are saved
+JOURNAL_SUFFIX = '.journal' # Sidecar file recording the completed byte ranges of a download
+JOURNAL_SAVE_INTERVAL = 1.0 # Minimum time between journal saves during a transfer (seconds)
+DIGEST_BLOCK_SIZE = 1024 * 1024 # Read size when verifying a downloaded file
+HASH_PENDING_LIMIT = 16 * 1024 * 1024 # Out-of-order bytes buffered for on-the-fly hashing
+BLOCK_HASH_ALGORITHM = 'BLAKE2B-128' # Per-chunk hash proposed for delta sync with 'DELTA'
+BLOCK_HASH_SIZE = 16    # Bytes per block hash (BLAKE2b with a 128-bit digest)
+HASHES_PER_PACKET = 2048 # Block hashes asked for per PKT_HASH_REQ (the server may send fewer)
+HASH_REQUESTS_IN_FLIGHT = 8 # PKT_HASH_REQs kept outstanding while fetching block hashes
+HASH_PENDING_DELAY = 0.5 # Pause before asking again while the server is still hashing the file (seconds)
+HASH_WAIT_LIMIT = 30.0  # Longest wait for the block hashes before fetching the whole file instead (seconds)
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+LOG_RATE = 20           # Default max log lines per second from one place in the code; the rest are counted
+PROGRESS_INTERVAL = 1.0 # Minimum time between progress lines of one session (seconds)
+RTT_HISTOGRAM_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000) # Upper bounds of the RTT histogram buckets
+
+# --- Binary wire format (negotiated with 'FORMAT BINARY'; must match UDPserver.py) ---
+# magic, packet type, flags, session id, byte offset, payload length, payload CRC32; raw payload follows.
+PACKET_HEADER = struct.Struct('!BBHIQII')
+PACKET_MAGIC = 0xB7
+PKT_REQ = 1
+PKT_DATA = 2
+PKT_PARITY = 3
+PKT_HASH_REQ = 4
+PKT_HASHES = 5
+FLAG_LAST_CHUNK = 0x1
+FLAG_CRC = 0x2
+
+# --- Logging ---
+logger = logging.getLogger('udpclient')
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `rate` records per second through from each place in the code (file and line),
+    so a burst of timeouts or bad packets cannot flood the terminal. The number of records dropped
+    is appended to the next record from that place that gets through. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.windows = {} # (pathname, lineno) -> [window start, records let through, records dropped]
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= 1.0:
+                dropped = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < self.rate:
+                window[1] += 1
+                dropped, window[2] = window[2], 0
+            else:
+                window[2] += 1
+                return False
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} similar messages suppressed)"
+            record.args = ()
+        return True
+
+def configure_logging(level='info', rate=LOG_RATE):
+    """
+    Sends the client log to stdout at `level` (debug, info, warning or error). Progress is
+    logged at most every PROGRESS_INTERVAL seconds per session, never per chunk.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter(rate))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
 
 # --- Helper Function to ensure directory exists ---
 def ensure_dir(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
-        print(f"Created directory: {directory}")
+        logger.info(f"Created directory: {directory}")
+
+# --- Transfer metrics, dumped with --stats-json ---
+class Histogram:
+    """Counts values into buckets with the given upper bounds, plus one bucket for larger values."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+
+    def snapshot(self):
+        buckets = {f"<={bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return buckets
+
+class SessionMetrics:
+    """
+    Counters of one transfer session (a file, a stripe or a DOWNLOAD_MANY batch), updated by the
+    thread running it. Also logs the session's progress, at most every PROGRESS_INTERVAL seconds.
+    """
+
+    def __init__(self, label):
+        self.label = label
+        self.started = time.monotonic()
+        self.ended = None
+        self.bytes_received = 0
+        self.chunks_received = 0
+        self.requests_sent = 0
+        self.retransmits = 0
+        self.crc_errors = 0
+        self.duplicates = 0
+        self.parity_received = 0
+        self.fec_recovered = 0
+        self.rtt_histogram = Histogram(RTT_HISTOGRAM_BOUNDS_MS)
+        self.rtt_samples = 0
+        self.rtt_total = 0.0
+        self.next_progress = self.started + PROGRESS_INTERVAL
+
+    def record_rtt(self, rtt):
+        self.rtt_histogram.add(rtt * 1000)
+        self.rtt_samples += 1
+        self.rtt_total += rtt
+
+    def record_chunk(self, length):
+        self.bytes_received += length
+        self.chunks_received += 1
+        now = time.monotonic()
+        if now >= self.next_progress:
+            self.next_progress = now + PROGRESS_INTERVAL
+            logger.info(f"{self.label}: {self.bytes_received} bytes received "
+                        f"({self.bytes_received / (now - self.started) / 1e6:.2f} MB/s).")
+
+    def finish(self):
+        self.ended = time.monotonic()
+
+    def snapshot(self):
+        elapsed = max((self.ended or time.monotonic()) - self.started, 1e-9)
+        return {
+            'session': self.label,
+            'duration_s': round(elapsed, 3),
+            'bytes_received': self.bytes_received,
+            'chunks_received': self.chunks_received,
+            'requests_sent': self.requests_sent,
+            'retransmits': self.retransmits,
+            'crc_errors': self.crc_errors,
+            'duplicates': self.duplicates,
+            'parity_received': self.parity_received,
+            'fec_recovered': self.fec_recovered,
+            'rtt_mean_ms': round(self.rtt_total / self.rtt_samples * 1000, 3) if self.rtt_samples else None,
+            'rtt_histogram_ms': self.rtt_histogram.snapshot(),
+            'throughput_bps': round(self.bytes_received / elapsed),
+        }
+
+class MetricsRegistry:
+    """Collects the metrics of every session this client ran. Thread-safe."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = []
+
+    def open(self, label):
+        session_metrics = SessionMetrics(label)
+        with self.lock:
+            self.sessions.append(session_metrics)
+        return session_metrics
+
+    def snapshot(self):
+        with self.lock:
+            sessions = [session_metrics.snapshot() for session_metrics in self.sessions]
+        totals = {key: sum(session[key] for session in sessions)
+                  for key in ('bytes_received', 'chunks_received', 'requests_sent', 'retransmits', 'crc_errors', 'duplicates',
+                              'parity_received', 'fec_recovered')}
+        return {'totals': totals, 'sessions': sessions}
+
+# The registry every session of this client reports to
+metrics_registry = MetricsRegistry()
+
+# --- Round-trip time estimation (Jacobson/Karels) ---
+class RttEstimator:
+    """
+    Tracks the smoothed RTT and RTT variance of one session and derives the retransmission
+    timeout RTO = SRTT + max(G, 4 * RTTVAR) (RFC 6298), clamped to [MIN_RTO, MAX_RTO].
+    Callers only feed samples from requests that were sent once (Karn's rule): the reply to a
+    retransmitted request cannot be matched to a particular transmission.
+    The session's metrics (a private SessionMetrics unless one is given) see every sample too.
+    """
+
+    def __init__(self, initial_rto=INITIAL_TIMEOUT, metrics=None):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.metrics = metrics if metrics is not None else SessionMetrics('session')
+
+    def sample(self, rtt):
+        self.metrics.record_rtt(rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - RTT_BETA) * self.rttvar + RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - RTT_ALPHA) * self.srtt + RTT_ALPHA * rtt
+        self.rto = min(max(self.srtt + max(RTO_GRANULARITY, 4 * self.rttvar), MIN_RTO), MAX_RTO)
+
+    def backoff(self):
+        # Keep the backed-off value until the next valid sample
+        self.rto = min(self.rto * TIMEOUT_MULTIPLIER, MAX_RTO)
+
+# --- Congestion control (AIMD) ---
+class CongestionWindow:
+    """
+    Decides how many chunk requests a windowed transfer keeps in flight, and with that how fast
+    the server sends (it only sends DATA in reply to a REQ). Slow start grows the window by one
+    chunk per reply up to ssthresh, congestion avoidance then by about one chunk per round trip.
+    A timed-out request halves the window, once per window of requests: losses of requests sent
+    before the last reduction belong to the same congestion event.
+    The negotiated WINDOW is the ceiling, like a receiver window.
+    """
+
+    def __init__(self, max_window):
+        self.max_window = max_window
+        self.size = float(min(INITIAL_CWND, max_window))
+        self.ssthresh = float(max_window)
+        self.sequence = 0        # Requests sent so far
+        self.recovery_point = 0  # Sequence number of the last request sent before the last reduction
+
+    def next_sequence(self):
+        self.sequence += 1
+        return self.sequence
+
+    def allowed(self):
+        return max(int(self.size), 1)
+
+    def on_ack(self):
+        if self.size < self.ssthresh:
+            self.size += 1
+        else:
+            self.size += 1 / self.size
+        self.size = min(self.size, self.max_window)
+
+    def on_loss(self, sequence):
+        if sequence <= self.recovery_point:
+            return
+        self.ssthresh = max(self.size / 2, MIN_CWND)
+        self.size = self.ssthresh
+        self.recovery_point = self.sequence
+
+# --- Helper Function for the give-up deadline ---
+def retry_budget(timeout, max_retries):
+    """
+    Total time the fixed exponential backoff spends before giving up (1 + 2 + 4 + ... timeouts).
+    Adaptive timeouts retry faster, but only give up after at least this long, so a short
+    outage is not mistaken for a dead peer.
+    """
+    return sum(timeout * TIMEOUT_MULTIPLIER ** attempt for attempt in range(max_retries))
 
 # --- Function to send and wait for a response ---
-def send_and_receive(sock, message, server_address, timeout, max_retries):
+def send_and_receive(sock, message, server_address, timeout, max_retries, rtt=None):
     """
     Sends a message and waits for a response with timeout and retransmissions.
+    With an RttEstimator the first timeout is its current RTO instead of `timeout`, the
+    round trip of a message answered on its first transmission is fed back to it, and it keeps
+    retrying until both max_retries and the fixed-backoff time budget are used up.
     Returns (response_data, sender_address) or (None, None) on failure.
     """
     encoded_message = message.encode('utf-8')
     retries = 0
-    current_timeout = timeout
+    current_timeout = rtt.rto if rtt is not None else timeout
+    give_up_at = time.monotonic() + retry_budget(timeout, max_retries)
 
-    while retries < max_retries:
+    while retries < max_retries or (rtt is not None and time.monotonic() < give_up_at):
         try:
+            sent_at = time.monotonic()
             sock.sendto(encoded_message, server_address)
+            if rtt is not None:
+                rtt.metrics.requests_sent += 1
+                if retries > 0:
+                    rtt.metrics.retransmits += 1
             sock.settimeout(current_timeout)
-            response_data, sender_address = sock.recvfrom(2048) # Buffer for response
+            response_data, sender_address = sock.recvfrom(RECV_BUFFER_SIZE)
+            if rtt is not None and retries == 0:
+                rtt.sample(time.monotonic() - sent_at)
             return response_data, sender_address
         except socket.timeout:
             retries += 1
+            if rtt is not None:
+                rtt.backoff()
             # For brevity in logs, only print first line of message if it's multi-line (e.g., REQ messages)
-            log_message = message.splitlines()[0] 
-            print(f"Timeout (attempt {retries}/{max_retries}) for '{log_message}'. Retrying with timeout {current_timeout * TIMEOUT_MULTIPLIER:.2f}s...")
             current_timeout *= TIMEOUT_MULTIPLIER # Exponential backoff
+            if rtt is not None:
+                current_timeout = min(current_timeout, MAX_RTO)
+            log_message = message.splitlines()[0][:80]
+            logger.warning(f"Timeout (attempt {retries}/{max_retries}) for '{log_message}'. Retrying with timeout {current_timeout:.2f}s...")
         except Exception as e:
-            log_message = message.splitlines()[0]
-            print(f"Error sending/receiving for '{log_message}': {e}")
+            log_message = message.splitlines()[0][:80]
+            logger.error(f"Error sending/receiving for '{log_message}': {e}")
             return None, None
-    log_message = message.splitlines()[0]
-    print(f"Max retries reached for '{log_message}'. Giving up.")
+    log_message = message.splitlines()[0][:80]
+    logger.error(f"Max retries reached for '{log_message}'. Giving up.")
     return None, None
 
-# --- Main Client Logic ---
-def run_client(server_host, server_port, files_list_path):
-    ensure_dir(CLIENT_FILES_DIR) # Ensure the client_files directory exists
+# --- Helper Function to back off from a server at its session cap ---
+def busy_delay(response_data, attempt):
+    """
+    Returns how long to wait before asking again if the server answered
+    "BUSY <name> RETRY_AFTER <seconds>", else None. The hint doubles with every attempt and is
+    randomized, so clients turned away together do not all come back at the same moment.
+    """
+    parts = response_data.split() if response_data is not None else []
+    if len(parts) != 4 or parts[0] != b"BUSY" or parts[2] != b"RETRY_AFTER":
+        return None
+    try:
+        retry_after = float(parts[3])
+    except ValueError:
+        return None
+    return min(retry_after * TIMEOUT_MULTIPLIER ** attempt, MAX_BUSY_DELAY) * random.uniform(0.5, 1.5)
+
+# --- Helper Function to parse trailing 'KEY VALUE' options of a message ---
+def parse_options(tokens):
+    """
+    Turns ['WINDOW', '32', ...] into {'WINDOW': '32', ...}.
+    Returns None if the tokens do not form complete KEY VALUE pairs.
+    """
+    if len(tokens) % 2 != 0:
+        return None
+    return {tokens[i].upper(): tokens[i + 1] for i in range(0, len(tokens), 2)}
+
+# --- Helper Function to parse a DATA packet ---
+def parse_data_packet(chunk_response_msg, filename):
+    """
+    Splits "DATA <filename> START <start> END <end> [CRC <crc32>] <base64>".
+    Returns (start_byte, end_byte, encoded_chunk, crc), with crc None if the packet carries none,
+    or None if the packet is not a DATA packet for this file.
+    Raises ValueError if the byte offsets or the CRC cannot be parsed.
+    """
+    chunk_parts = chunk_response_msg.split(' ', 5) # Split into 5 parts, the last one being the base64 data
+    if len(chunk_parts) == 6 and chunk_parts[0] == "DATA" and \
+       chunk_parts[1] == filename and chunk_parts[2] == "START" and \
+       chunk_parts[4] == "END":
+        received_start_byte = int(chunk_parts[3])
+        # The last part includes "<end_byte> <base64_data>"
+        # We need to split that again to get just the end_byte
+        end_byte_str, encoded_chunk = chunk_parts[5].split(' ', 1)
+        crc = None
+        if encoded_chunk.startswith("CRC "):
+            # Base64 never contains spaces, so "CRC <crc32> <base64>" is unambiguous
+            _, crc_str, encoded_chunk = encoded_chunk.split(' ', 2)
+            crc = int(crc_str)
+        return received_start_byte, int(end_byte_str), encoded_chunk, crc
+    return None
+
+# --- Helper Function to parse a binary DATA packet ---
+def parse_binary_data_packet(packet, expected_type=PKT_DATA):
+    """
+    Unpacks the fixed header of a binary DATA (or, with expected_type=PKT_PARITY, FEC parity) packet.
+    Returns (session_id, offset, payload, crc) with payload as a memoryview slice of `packet`
+    and crc None unless the packet carries one, or None if the packet is not of that type.
+    """
+    if len(packet) < PACKET_HEADER.size or packet[0] != PACKET_MAGIC:
+        return None
+    _, packet_type, flags, packet_session, offset, length, crc = PACKET_HEADER.unpack_from(packet)
+    if packet_type != expected_type:
+        return None
+    return packet_session, offset, memoryview(packet)[PACKET_HEADER.size:PACKET_HEADER.size + length], crc if flags & FLAG_CRC else None
 
-    # The main_client_socket will only be used to get the server_address initially, 
-    # not for sending/receiving as we'll use per-file sockets.
-    # We still need it to define server_address for initial connections.
+# --- Helper Function to build the options this client proposes in DOWNLOAD ---
+def build_proposals(window, binary, checksum=True, chunk_size=None, fec=None, delta=False):
+    proposals = {}
+    if window > 1:
+        proposals['WINDOW'] = window
+        if binary:
+            proposals['FORMAT'] = 'BINARY'
+            if fec is not None:
+                proposals['FEC'], proposals['FEC_PARITY'] = fec
+            if delta:
+                proposals['DELTA'] = BLOCK_HASH_ALGORITHM
+        if checksum:
+            proposals['CHECKSUM'] = 'CRC32'
+        if chunk_size is not None and chunk_size != CHUNK_SIZE:
+            proposals['CHUNK'] = chunk_size
+    return proposals
+
+# --- Helper Function to read the FEC parameters the server accepted ---
+def negotiated_fec(options):
+    """Returns (group, parity_count) if the server echoed FEC, else None."""
+    if 'FEC' not in options:
+        return None
+    return int(options['FEC']), int(options.get('FEC_PARITY', 1))
+
+# --- Helper Function to pick a chunk size that avoids IP fragmentation ---
+def probe_chunk_size(server_host, server_port, binary):
+    """
+    Largest chunk whose DATA datagram fits the path MTU to the server, as far as the local
+    routing table knows it (IP_MTU of a connected socket, Linux only). A single lost fragment
+    loses the whole datagram, so on lossy paths this can beat the larger default.
+    Falls back to CHUNK_SIZE if the MTU cannot be read.
+    """
+    probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        probe_socket.connect((server_host, server_port))
+        mtu = probe_socket.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError as e:
+        logger.warning(f"Could not read the path MTU ({e}). Using {CHUNK_SIZE}-byte chunks.")
+        return CHUNK_SIZE
+    finally:
+        probe_socket.close()
+    room = mtu - IP_UDP_HEADER_SIZE
+    chunk_size = room - PACKET_HEADER.size if binary else (room - TEXT_DATA_OVERHEAD) * 3 // 4
+    chunk_size = max(min(chunk_size, MAX_CHUNK_SIZE), 1)
+    logger.info(f"Path MTU to {server_host} is {mtu} bytes; proposing {chunk_size}-byte chunks.")
+    return chunk_size
+
+# --- Helper Function to size the receive buffer of a data socket ---
+def tune_receive_buffer(sock, window, chunk_size):
+    """
+    Asks for a receive buffer that holds a full window of DATA datagrams and returns the window
+    that the buffer the kernel actually granted can hold (Linux caps it at net.core.rmem_max).
+    Keeping no more requests in flight than that avoids drops of our own making.
+    """
+    datagram_size = chunk_size + DATAGRAM_OVERHEAD
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, min(window * datagram_size, SOCKET_BUFFER_SIZE))
+        granted = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    except OSError as e:
+        logger.warning(f"Could not set socket buffer size: {e}")
+        return window
+    return max(min(window, granted // datagram_size), MIN_CWND)
+
+# --- Handshake: ask the main server port for a file ---
+legacy_servers = set()  # Server addresses that only answered the plain legacy DOWNLOAD
+legacy_servers_lock = threading.Lock() # --parallel downloads share legacy_servers
+
+def request_download(server_address, filename, proposals, rtt=None, wait_if_busy=True):
+    """
+    Sends DOWNLOAD for one file, appending the proposed options as KEY VALUE pairs.
+    Falls back to the plain legacy request if the server does not answer the extended one, and
+    then sends only legacy requests to that server, so later files do not wait out the same
+    negotiation timeouts.
+    A BUSY answer is retried for up to BUSY_WAIT_LIMIT seconds if `wait_if_busy`.
+    The handshake round trip seeds `rtt`, if given.
+    Returns the decoded response message, or None if the server never answered.
+    """
+    with legacy_servers_lock:
+        if server_address in legacy_servers:
+            proposals = {}
+    download_request = f"DOWNLOAD {filename}"
+    download_request += ''.join(f" {key} {value}" for key, value in proposals.items())
+
+    # Create a new socket for *each* initial DOWNLOAD handshake.
+    # This isolates responses for each file, preventing old messages from interfering.
+    initial_handshake_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Bind to a random available port to ensure a clean slate for this specific handshake.
+    initial_handshake_socket.bind(('', 0))
+    try:
+        retries = NEGOTIATION_RETRIES if proposals else MAX_RETRIES
+        give_up_at = time.monotonic() + BUSY_WAIT_LIMIT
+        attempt = 0
+        while True:
+            response_data, _ = send_and_receive(initial_handshake_socket, download_request, server_address, INITIAL_TIMEOUT, retries, rtt)
+            delay = busy_delay(response_data, attempt)
+            if delay is None or not wait_if_busy or time.monotonic() + delay > give_up_at:
+                break
+            logger.info(f"Server busy; asking again for '{filename}' in {delay:.1f}s.")
+            time.sleep(delay)
+            attempt += 1
+        if response_data is None and proposals:
+            # Servers predating option negotiation silently drop DOWNLOADs with extra tokens
+            logger.warning(f"No answer to '{download_request}'. Falling back to the legacy protocol.")
+            if rtt is not None:
+                # Silence was the old server ignoring options, not the network: drop the backed-off RTO
+                rtt.rto = INITIAL_TIMEOUT
+            response_data, _ = send_and_receive(initial_handshake_socket, f"DOWNLOAD {filename}", server_address, INITIAL_TIMEOUT, MAX_RETRIES, rtt)
+            if response_data is not None:
+                with legacy_servers_lock:
+                    legacy_servers.add(server_address)
+    finally:
+        # Close the socket immediately after getting the response for this handshake.
+        initial_handshake_socket.close()
+
+    if response_data is None:
+        return None
+    return response_data.decode('utf-8').strip()
+
+# --- Download journal: completed byte ranges, for resuming ---
+class DownloadJournal:
+    """
+    Records which byte ranges of a download are on disk in a sidecar JSON file (<file>.journal),
+    so a failed or killed download can be resumed with --resume by requesting only the missing
+    chunks. Saved at most every JOURNAL_SAVE_INTERVAL seconds, and only after an fsync of the
+    data file, so it never claims bytes that could still be lost.
+    While a fresh download with a known digest arrives in order it also hashes the data on the
+    fly, which saves reading the file back to check the digest; chunks arriving ahead of the hash
+    are buffered up to HASH_PENDING_LIMIT bytes, after which on-the-fly hashing is dropped.
+    Thread-safe, so the stripes of one file share one journal.
+    """
+
+    def __init__(self, path, file_size, digest=None, ranges=()):
+        self.path = path
+        self.file_size = file_size
+        self.digest = digest      # "sha256:<hex>" from the server, if it sent one
+        self.starts = []          # Sorted, merged [start, end) ranges on disk
+        self.ends = []
+        for start, end in ranges:
+            self._add(start, end)
+        self.lock = threading.Lock()
+        self.file = None          # The open data file, fsynced before every save
+        self.saved_at = time.monotonic()
+        # Only worth hashing if there is a digest to check against
+        self.sha256 = hashlib.sha256() if digest is not None and not self.starts else None
+        self.hashed = 0           # Bytes fed to sha256 so far, always a prefix of the file
+        self.pending = {}         # offset -> chunk received ahead of the hash
+        self.pending_bytes = 0
+
+    @classmethod
+    def load(cls, path, file_size, digest):
+        """
+        Returns the journal saved at `path` if it belongs to this version of the file (same size,
+        and the same digest when both are known), otherwise None.
+        """
+        try:
+            with open(path, 'r') as journal_file:
+                saved = json.load(journal_file)
+            if saved['size'] != file_size or (digest and saved['digest'] and saved['digest'] != digest):
+                return None
+            return cls(path, file_size, digest or saved['digest'], saved['ranges'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def record(self, offset, data):
+        """Marks `data`, just written at `offset`, as on disk."""
+        with self.lock:
+            self._add(offset, offset + len(data))
+            if self.sha256 is not None:
+                self._hash_in_order(offset, data)
+            if time.monotonic() - self.saved_at >= JOURNAL_SAVE_INTERVAL:
+                self._save()
+
+    def completed_bytes(self):
+        with self.lock:
+            return sum(end - start for start, end in zip(self.starts, self.ends))
+
+    def missing_chunks(self, first, end, chunk_size):
+        """Yields the indices in first..end-1 of the chunks that are not completely on disk."""
+        with self.lock:
+            ranges = list(zip(self.starts, self.ends))
+        k = 0
+        for index in range(first, end):
+            start = index * chunk_size
+            stop = min(start + chunk_size, self.file_size)
+            while k < len(ranges) and ranges[k][1] <= start:
+                k += 1
+            if k < len(ranges) and ranges[k][0] <= start and ranges[k][1] >= stop:
+                continue
+            yield index
+
+    def hexdigest(self):
+        """SHA-256 of the file hashed on the fly, or None if it was not hashed completely."""
+        with self.lock:
+            if self.sha256 is None or self.hashed != self.file_size:
+                return None
+            return self.sha256.hexdigest()
+
+    def save(self):
+        with self.lock:
+            self._save()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _add(self, start, end):
+        # Merge [start, end) with every range it overlaps or touches
+        i = bisect_left(self.ends, start)
+        j = bisect_right(self.starts, end)
+        if i < j:
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def _hash_in_order(self, offset, data):
+        # Caller holds self.lock
+        if offset > self.hashed:
+            self.pending[offset] = bytes(data)
+            self.pending_bytes += len(data)
+            if self.pending_bytes > HASH_PENDING_LIMIT:
+                # Too far out of order (stripes); verify with a read pass at the end instead
+                self.sha256 = None
+                self.pending.clear()
+            return
+        if offset < self.hashed:
+            return
+        self.sha256.update(data)
+        self.hashed += len(data)
+        while self.hashed in self.pending:
+            chunk = self.pending.pop(self.hashed)
+            self.pending_bytes -= len(chunk)
+            self.sha256.update(chunk)
+            self.hashed += len(chunk)
+
+    def _save(self):
+        # Caller holds self.lock. Data first, then the journal that describes it.
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as journal_file:
+            json.dump({'size': self.file_size, 'digest': self.digest,
+                       'ranges': [[start, end] for start, end in zip(self.starts, self.ends)]}, journal_file)
+        os.replace(temporary_path, self.path)
+        self.saved_at = time.monotonic()
+
+# --- Delta sync: fetch only the chunks in which the local copy differs ---
+def fetch_block_hashes(data_transfer_socket, data_server_address, session_id, file_size, chunk_size, rtt):
+    """
+    Asks the server for the block hash of every chunk of the file, HASHES_PER_PACKET chunks per
+    PKT_HASH_REQ with up to HASH_REQUESTS_IN_FLIGHT requests outstanding; a request is repeated
+    when its reply does not arrive within the RTO, or after HASH_PENDING_DELAY while the server
+    is still hashing the file. Returns the concatenated hashes, or None if they did not all
+    arrive within HASH_WAIT_LIMIT seconds.
+    """
+    hashes = bytearray(math.ceil(file_size / chunk_size) * BLOCK_HASH_SIZE)
+    span = HASHES_PER_PACKET * chunk_size
+    # Byte offset of a range of chunks without hashes yet -> [end of the range, time to (re)send its request]
+    missing = {offset: [min(offset + span, file_size), 0.0] for offset in range(0, file_size, span)}
+    request_header = bytearray(PACKET_HEADER.size)
+    give_up_at = time.monotonic() + HASH_WAIT_LIMIT
+    while missing:
+        now = time.monotonic()
+        if now >= give_up_at:
+            logger.warning(f"No block hashes from the server within {HASH_WAIT_LIMIT:.0f} seconds.")
+            return None
+        outstanding = list(missing.items())[:HASH_REQUESTS_IN_FLIGHT]
+        for offset, entry in outstanding:
+            if entry[1] <= now:
+                PACKET_HEADER.pack_into(request_header, 0, PACKET_MAGIC, PKT_HASH_REQ, 0, session_id, offset, entry[0] - offset, 0)
+                data_transfer_socket.sendto(request_header, data_server_address)
+                rtt.metrics.requests_sent += 1
+                entry[1] = now + rtt.rto
+        data_transfer_socket.settimeout(max(min(entry[1] for _, entry in outstanding) - now, 0.001))
+        try:
+            reply = parse_binary_data_packet(data_transfer_socket.recv(RECV_BUFFER_SIZE), PKT_HASHES)
+        except socket.timeout:
+            continue
+        if reply is None or reply[0] != session_id or reply[1] not in missing:
+            continue # Late duplicate
+        _, offset, payload, crc = reply
+        if crc is not None and zlib.crc32(payload) != crc:
+            continue
+        if not payload:
+            missing[offset][1] = time.monotonic() + HASH_PENDING_DELAY
+            continue
+        end = missing.pop(offset)[0]
+        first = offset // chunk_size
+        payload = payload[:(math.ceil((end - offset) / chunk_size)) * BLOCK_HASH_SIZE]
+        hashes[first * BLOCK_HASH_SIZE:first * BLOCK_HASH_SIZE + len(payload)] = payload
+        covered = offset + len(payload) // BLOCK_HASH_SIZE * chunk_size
+        if covered < end:
+            # The server sent fewer hashes than asked for
+            missing[covered] = [end, 0.0]
+    return bytes(hashes)
+
+def open_delta_journal(output_file_path, file_size, expected_digest, chunk_size, block_hashes):
+    """
+    Compares the chunks of the local copy with the server's block hashes and returns a fresh
+    journal that lists the matching chunks as already on disk, so only the others are requested.
+    The local copy is cut or extended to the new file size.
+    """
+    matching = []
+    with open(output_file_path, 'r+b') as f:
+        for index in range(len(block_hashes) // BLOCK_HASH_SIZE):
+            start = index * chunk_size
+            length = min(chunk_size, file_size - start)
+            block = f.read(length)
+            if len(block) == length and hashlib.blake2b(block, digest_size=BLOCK_HASH_SIZE).digest() == \
+               block_hashes[index * BLOCK_HASH_SIZE:(index + 1) * BLOCK_HASH_SIZE]:
+                matching.append((start, start + length))
+        f.truncate(file_size)
+    return DownloadJournal(output_file_path + JOURNAL_SUFFIX, file_size, expected_digest, matching)
+
+# --- Helper Function to check a download against the server's whole-file digest ---
+def verify_digest(path, expected_digest, journal=None):
+    """
+    Compares the file with the "sha256:<hex>" digest from the OK reply. Uses the hash the journal
+    computed while the file arrived if there is one, otherwise reads the file back.
+    Returns True if the digest matches or uses an algorithm this client does not know.
+    """
+    algorithm, _, expected_hex = expected_digest.partition(':')
+    if algorithm != 'sha256':
+        logger.warning(f"Cannot verify digest of unknown type '{algorithm}'.")
+        return True
+    actual_hex = journal.hexdigest() if journal is not None else None
+    if actual_hex is None:
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b''):
+                sha256.update(block)
+        actual_hex = sha256.hexdigest()
+    return actual_hex == expected_hex
+
+# --- Helpers shared by single and batch downloads: journal setup and final check ---
+def open_journal(output_file_path, file_size, expected_digest, resume):
+    """
+    Returns (journal, resuming): with `resume`, the saved journal of an interrupted download of
+    this file if it still matches, otherwise a fresh journal (None for an empty file).
+    """
+    journal_path = output_file_path + JOURNAL_SUFFIX
+    if resume and os.path.exists(output_file_path):
+        journal = DownloadJournal.load(journal_path, file_size, expected_digest)
+        if journal is not None:
+            return journal, True
+    return (DownloadJournal(journal_path, file_size, expected_digest) if file_size > 0 else None), False
+
+def check_download(result, output_file_path, expected_digest, journal=None):
+    """
+    Checks a complete download against the server digest, setting status 'corrupt' on a mismatch,
+    and removes the journal once the file is complete or useless.
+    """
+    filename = result['filename']
+    if result['status'] == 'ok' and expected_digest is not None:
+        if verify_digest(output_file_path, expected_digest, journal):
+            logger.info(f"Verified '{filename}' against the server digest.")
+        else:
+            logger.error(f"'{filename}' does not match the server digest. Discarding progress.")
+            result['status'] = 'corrupt'
+    if journal is not None and result['status'] in ('ok', 'corrupt'):
+        journal.remove()
+
+# --- Legacy transfer: one outstanding REQ at a time ---
+def download_stop_and_wait(data_transfer_socket, data_server_address, filename, f, file_size, rtt=None):
+    """
+    Fetches the file chunk by chunk, waiting for each DATA before asking for the next.
+    Each wait starts at the session's adaptive RTO when an RttEstimator is given.
+    Returns the number of contiguous bytes written.
+    """
+    current_offset = 0
+    while current_offset < file_size:
+        # Calculate the end byte for the current chunk
+        chunk_end_byte = min(current_offset + CHUNK_SIZE - 1, file_size - 1)
+
+        # Handle case of 0-byte file (file_size=0) or last chunk where no more data
+        if file_size == 0 or chunk_end_byte < current_offset:
+            break
+
+        # Send REQ for the next chunk
+        chunk_request = f"REQ {filename} START {current_offset} END {chunk_end_byte}"
+        chunk_response_data, _ = send_and_receive(data_transfer_socket, chunk_request, data_server_address, INITIAL_TIMEOUT, MAX_RETRIES, rtt)
+
+        if chunk_response_data is None:
+            logger.error(f"Failed to receive chunk for offset {current_offset}. Aborting download of '{filename}'.")
+            break # Break from inner while loop
+
+        chunk_response_msg = chunk_response_data.decode('utf-8').strip()
+        chunk_parts = chunk_response_msg.split()
+
+        try:
+            data_packet = parse_data_packet(chunk_response_msg, filename)
+        except ValueError:
+            logger.warning(f"Error parsing chunk start/end bytes for '{filename}'. Skipping this chunk.")
+            continue # Skip to next iteration, possibly re-requesting same chunk
+
+        if data_packet is not None:
+            received_start_byte, _, encoded_chunk, crc = data_packet
+            if received_start_byte == current_offset:
+                try:
+                    decoded_chunk = base64.b64decode(encoded_chunk)
+                    if crc is not None and zlib.crc32(decoded_chunk) != crc:
+                        logger.warning(f"CRC mismatch in chunk at offset {current_offset} of '{filename}'. Retrying current chunk.")
+                        if rtt is not None:
+                            rtt.metrics.crc_errors += 1
+                        continue
+                    # Ensure we don't write beyond file size if chunk is malformed
+                    if current_offset + len(decoded_chunk) > file_size:
+                        decoded_chunk = decoded_chunk[:file_size - current_offset] # Truncate if too long
+
+                    write_at(f, decoded_chunk, current_offset)
+                    current_offset += len(decoded_chunk)
+                    if rtt is not None:
+                        rtt.metrics.record_chunk(len(decoded_chunk))
+                except Exception as e:
+                    logger.error(f"Error decoding or writing chunk for '{filename}': {e}. Skipping this chunk.")
+            else:
+                logger.warning(f"Received out-of-order chunk for '{filename}'. Expected offset {current_offset}, got {received_start_byte}. Retrying current chunk.")
+                # If out-of-order, don't advance offset. Next iteration will re-request current_offset.
+        elif len(chunk_parts) >= 3 and chunk_parts[0] == "FILE" and chunk_parts[1] == filename and chunk_parts[2] == "CLOSE_OK":
+            # This can happen if the server already finished sending and client was late with a REQ
+            # or if the file was very small and server sent CLOSE_OK immediately after the only chunk.
+            logger.warning("Server sent CLOSE_OK prematurely (or file was fully downloaded).")
+            break # Exit the chunk loop if server says it's done
+        elif len(chunk_parts) >= 3 and chunk_parts[0] == "ERR" and chunk_parts[1] == filename and chunk_parts[2] == "NOT_FOUND":
+            logger.error(f"Server reported '{filename}' not found during data transfer. Aborting.")
+            break
+        else:
+            logger.error(f"Received unexpected data packet format for '{filename}': {chunk_response_msg[:80]}")
+            # Decide whether to retry or abort
+            break # Abort for now
+    return current_offset
+
+# --- Windowed transfer: selective repeat with several REQs in flight ---
+class ChunkTarget:
+    """
+    One file fetched by download_chunks: where its chunks are written, which of them to request
+    and the session id (file id) its binary packets carry, None for the text format.
+    chunk_range=(first, end) limits it to chunk indices first..end-1 (one stripe). With a journal
+    only the chunks it does not list as on disk are requested, and every chunk written is recorded.
+    """
+
+    def __init__(self, filename, f, file_size, session_id=None, journal=None, chunk_range=None, chunk_size=CHUNK_SIZE):
+        self.filename = filename
+        self.f = f
+        self.file_size = file_size
+        self.session_id = session_id
+        self.journal = journal
+        first_chunk, end_chunk = chunk_range if chunk_range is not None else (0, math.ceil(file_size / chunk_size))
+        if journal is not None:
+            self.chunks = journal.missing_chunks(first_chunk, end_chunk, chunk_size)
+        else:
+            self.chunks = iter(range(first_chunk, end_chunk))
+        self.bytes_written = 0
+
+class FecDecoder:
+    """
+    Rebuilds lost chunks from the XOR parity packets of the FEC mode. Within a group of `group`
+    chunks, parity packet j covers chunks j, j + parity_count, j + 2 * parity_count, ... (the
+    "subset" starting at chunk j); once all but one of them arrived, the missing one is the XOR of
+    the parity and the others. Only subsets whose chunks were all requested by this download are
+    rebuilt; chunks already on disk (resume) or in another stripe are left to retransmission.
+    """
+
+    def __init__(self, group, parity_count):
+        self.group = group
+        self.parity_count = parity_count
+        # (session id, first chunk of the subset) -> [XOR of the chunks received, chunk indices
+        # still missing, chunks requested so far, (parity, length) once it arrived]
+        self.subsets = {}
+
+    def subset(self, index, chunk_count):
+        """Returns the first chunk index and the chunk indices of the subset holding chunk `index`."""
+        group_start = index - index % self.group
+        first = group_start + (index - group_start) % self.parity_count
+        return first, range(first, min(group_start + self.group, chunk_count), self.parity_count)
+
+    def expect(self, session_id, index, chunk_count):
+        """Registers the first request for a chunk."""
+        first, _ = self.subset(index, chunk_count)
+        state = self.subsets.setdefault((session_id, first), [0, set(), 0, None])
+        state[1].add(index)
+        state[2] += 1
+
+    def add_chunk(self, session_id, index, chunk, chunk_count):
+        """Folds in a chunk that arrived; returns the (index, chunk) this made rebuildable, or None."""
+        first, members = self.subset(index, chunk_count)
+        state = self.subsets.get((session_id, first))
+        if state is None:
+            return None
+        state[0] ^= int.from_bytes(chunk, 'little')
+        state[1].discard(index)
+        return self.rebuild((session_id, first), len(members))
+
+    def add_parity(self, session_id, first, parity, chunk_count):
+        """Takes the parity of the subset starting at chunk `first`; returns a rebuilt (index, chunk), or None."""
+        state = self.subsets.get((session_id, first))
+        if state is None or first % self.group >= self.parity_count:
+            return None # Every chunk of the subset arrived already, or not a subset start at all
+        state[3] = (int.from_bytes(parity, 'little'), len(parity))
+        return self.rebuild((session_id, first), len(self.subset(first, chunk_count)[1]))
+
+    def rebuild(self, key, member_count):
+        state = self.subsets[key]
+        if not state[1]:
+            del self.subsets[key]
+            return None
+        if state[3] is None or len(state[1]) != 1 or state[2] != member_count:
+            return None
+        index = state[1].pop()
+        parity, length = state[3]
+        del self.subsets[key]
+        return index, (state[0] ^ parity).to_bytes(length, 'little')
+
+def download_windowed(data_transfer_socket, data_server_address, filename, f, file_size, window, session_id=None,
+                      chunk_range=None, rtt=None, journal=None, chunk_size=CHUNK_SIZE, fec=None):
+    """
+    Fetches one file, or one stripe of it, with download_chunks (see ChunkTarget for the arguments).
+    Returns the number of bytes written (equal to the missing bytes of the range on success).
+    """
+    target = ChunkTarget(filename, f, file_size, session_id, journal, chunk_range, chunk_size)
+    download_chunks(data_transfer_socket, data_server_address, [target], window, rtt, chunk_size, fec)
+    return target.bytes_written
+
+def download_chunks(data_transfer_socket, data_server_address, targets, window, rtt=None, chunk_size=CHUNK_SIZE, fec=None):
+    """
+    Keeps chunk requests outstanding, as many as the congestion window allows (at most `window`).
+    Every DATA packet acknowledges its chunk; chunks may arrive in any order and are written at
+    their own offset. A chunk whose reply does not arrive within the adaptive RTO is re-requested
+    on its own (selective repeat) with exponential backoff. Chunks failing their CRC32 are dropped
+    and re-requested.
+    Targets with a session id use the binary format for REQ and DATA packets, a single target
+    without one uses text. Several binary targets share the window and the socket: their packets
+    are told apart by session id, so the files of a batch are multiplexed over one data channel.
+    With fec=(group, parity_count) negotiated, lost chunks are also rebuilt from the server's
+    parity packets (see FecDecoder), usually before their RTO would re-request them.
+    Returns True if every requested chunk arrived, False if the transfer was aborted.
+    """
+    by_session = {target.session_id: target for target in targets}
+    by_name = {target.filename: target for target in targets}
+    chunk_counts = {target.session_id: math.ceil(target.file_size / chunk_size) for target in targets}
+    fec_decoder = FecDecoder(*fec) if fec is not None else None
+    arq_chunks = 0 # Chunks that had to be re-requested at least once
+    pending = ((target, index) for target in targets for index in target.chunks)
+    next_chunk = next(pending, None) # Next (target, chunk index) never requested so far
+    in_flight = {}            # (session id, chunk index) -> [deadline, attempts, sent_at, sequence, first_sent_at]
+    rtt = rtt if rtt is not None else RttEstimator()
+    metrics = rtt.metrics
+    fec_recovered_before = metrics.fec_recovered # The metrics may span several calls (batch rounds)
+    cwnd = CongestionWindow(window)
+    give_up_after = retry_budget(INITIAL_TIMEOUT, MAX_RETRIES)
+    # Every REQ is packed into, and every reply received into, the same buffers
+    request_header = bytearray(PACKET_HEADER.size)
+    receive_buffer = bytearray(RECV_BUFFER_SIZE)
+    receive_view = memoryview(receive_buffer)
+
+    def send_request(target, index, attempts, first_sent_at=None):
+        start_byte = index * chunk_size
+        end_byte = min(start_byte + chunk_size, target.file_size) - 1
+        if target.session_id is not None:
+            PACKET_HEADER.pack_into(request_header, 0, PACKET_MAGIC, PKT_REQ, 0, target.session_id, start_byte,
+                                    end_byte - start_byte + 1, 0)
+            chunk_request = request_header
+        else:
+            chunk_request = f"REQ {target.filename} START {start_byte} END {end_byte}".encode('utf-8')
+        sent_at = time.monotonic()
+        data_transfer_socket.sendto(chunk_request, data_server_address)
+        metrics.requests_sent += 1
+        if fec_decoder is not None and attempts == 1:
+            fec_decoder.expect(target.session_id, index, chunk_counts[target.session_id])
+        # Back off per attempt from the current RTO
+        timeout = min(rtt.rto * TIMEOUT_MULTIPLIER ** (attempts - 1), MAX_RTO)
+        in_flight[(target.session_id, index)] = [sent_at + timeout, attempts, sent_at, cwnd.next_sequence(), first_sent_at or sent_at]
+
+    def deliver(target, index, chunk):
+        """Writes a chunk that was in flight and acknowledges it; returns its in-flight entry."""
+        offset = index * chunk_size
+        chunk = chunk[:target.file_size - offset]
+        write_at(target.f, chunk, offset)
+        if target.journal is not None:
+            target.journal.record(offset, chunk)
+        entry = in_flight.pop((target.session_id, index))
+        cwnd.on_ack()
+        target.bytes_written += len(chunk)
+        metrics.record_chunk(len(chunk))
+        if fec_decoder is not None:
+            rebuilt = fec_decoder.add_chunk(target.session_id, index, chunk, chunk_counts[target.session_id])
+            if rebuilt is not None:
+                recover(target, *rebuilt)
+        return entry
+
+    def recover(target, index, chunk):
+        if (target.session_id, index) in in_flight:
+            metrics.fec_recovered += 1
+            deliver(target, index, chunk)
+
+    while True:
+        # Fill the congestion window with requests for chunks not asked for yet
+        while len(in_flight) < cwnd.allowed() and next_chunk is not None:
+            send_request(*next_chunk, 1)
+            next_chunk = next(pending, None)
+        if not in_flight:
+            break
+
+        earliest_deadline = min(entry[0] for entry in in_flight.values())
+        data_transfer_socket.settimeout(max(earliest_deadline - time.monotonic(), 0.001))
+        try:
+            nbytes, _ = data_transfer_socket.recvfrom_into(receive_buffer)
+            # Only valid until the next receive; payloads are written out before that
+            chunk_response_data = receive_view[:nbytes]
+        except socket.timeout:
+            chunk_response_data = None
+
+        data_packet = None # (target, offset, chunk, crc)
+        parity_packet = None # (session id, offset, parity, crc)
+        if chunk_response_data is not None:
+            binary_packet = parse_binary_data_packet(chunk_response_data)
+            if binary_packet is not None and binary_packet[0] in by_session:
+                data_packet = (by_session[binary_packet[0]],) + binary_packet[1:]
+            elif fec_decoder is not None:
+                parity_packet = parse_binary_data_packet(chunk_response_data, PKT_PARITY)
+        if parity_packet is not None:
+            session_id, received_start_byte, parity, crc = parity_packet
+            target = by_session.get(session_id)
+            if target is not None and received_start_byte % chunk_size == 0 and (crc is None or zlib.crc32(parity) == crc):
+                metrics.parity_received += 1
+                rebuilt = fec_decoder.add_parity(session_id, received_start_byte // chunk_size, parity, chunk_counts[session_id])
+                if rebuilt is not None:
+                    recover(target, *rebuilt)
+        elif chunk_response_data is not None and data_packet is None and chunk_response_data[:1] == bytes([PACKET_MAGIC]):
+            # A late reply to a block hash request, or a packet of a session this call is not serving
+            metrics.duplicates += 1
+        elif chunk_response_data is not None and data_packet is None:
+            chunk_response_msg = str(chunk_response_data, 'utf-8', errors='replace').strip()
+            parts = chunk_response_msg.split(' ', 2)
+            target = by_name.get(parts[1]) if len(parts) > 1 else None
+            text_packet = None
+            if target is not None and target.session_id is None:
+                try:
+                    text_packet = parse_data_packet(chunk_response_msg, target.filename)
+                except ValueError:
+                    text_packet = None
+                if text_packet is not None:
+                    received_start_byte, _, encoded_chunk, crc = text_packet
+                    try:
+                        data_packet = (target, received_start_byte, base64.b64decode(encoded_chunk), crc)
+                    except (binascii.Error, ValueError):
+                        # Like a CRC mismatch: left in flight, so it is re-requested when its deadline passes
+                        logger.warning(f"Undecodable chunk at offset {received_start_byte} of '{target.filename}'. Dropping it.")
+                        metrics.crc_errors += 1
+            if data_packet is None and text_packet is None:
+                if target is not None and chunk_response_msg.startswith(f"ERR {target.filename} NOT_FOUND"):
+                    logger.error(f"Server reported '{target.filename}' not found during data transfer. Aborting.")
+                    return False
+                logger.warning(f"Ignoring unexpected packet: {chunk_response_msg[:80]}")
+
+        if data_packet is not None:
+            target, received_start_byte, decoded_chunk, crc = data_packet
+            key = (target.session_id, received_start_byte // chunk_size)
+            if crc is not None and zlib.crc32(decoded_chunk) != crc:
+                # Left in flight, so it is re-requested when its deadline passes
+                logger.warning(f"CRC mismatch in chunk at offset {received_start_byte} of '{target.filename}'. Dropping it.")
+                metrics.crc_errors += 1
+            # Duplicates (a late reply to a retransmitted REQ) and misaligned offsets are dropped
+            elif received_start_byte % chunk_size == 0 and key in in_flight:
+                entry = deliver(target, key[1], decoded_chunk)
+                # Karn's rule: only a reply to a request sent once is an unambiguous RTT sample
+                if entry[1] == 1:
+                    rtt.sample(time.monotonic() - entry[2])
+            else:
+                metrics.duplicates += 1
+
+        # Re-request every chunk whose deadline has passed
+        now = time.monotonic()
+        for (session_id, index), (deadline, attempts, _sent_at, sequence, first_sent_at) in list(in_flight.items()):
+            if deadline > now:
+                continue
+            target = by_session[session_id]
+            if attempts >= MAX_RETRIES and now - first_sent_at >= give_up_after:
+                logger.error(f"Max retries reached for chunk at offset {index * chunk_size}. Aborting download of '{target.filename}'.")
+                return False
+            metrics.retransmits += 1
+            if attempts == 1:
+                arq_chunks += 1
+            cwnd.on_loss(sequence)
+            send_request(target, index, attempts + 1, first_sent_at) # Exponential backoff
+    fec_recovered = metrics.fec_recovered - fec_recovered_before
+    if fec_decoder is not None and (fec_recovered or arq_chunks):
+        logger.info(f"{metrics.label}: FEC rebuilt {fec_recovered} chunks; {arq_chunks} re-requested (ARQ).")
+    return True
+
+# --- Helper Function to preallocate the output file ---
+def preallocate(f, file_size):
+    """
+    Reserves the whole file up front, so positional writes in any order never extend it piece
+    by piece. Falls back to ftruncate() (a sparse file) where posix_fallocate() is unavailable
+    or not supported by the filesystem.
+    """
+    if file_size == 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, file_size)
+            return
+        except OSError:
+            pass
+    os.ftruncate(f.fileno(), file_size)
+
+# --- Helper Function for positional writes ---
+def write_at(f, data, offset):
+    """
+    Writes `data` at `offset` without moving a shared file position, so several stripes
+    can write into the same file concurrently.
+    """
+    if hasattr(os, 'pwrite'):
+        os.pwrite(f.fileno(), data, offset)
+    else:
+        with write_lock:
+            f.seek(offset)
+            f.write(data)
+            f.flush()
+
+write_lock = threading.Lock() # Serializes seek()+write() where os.pwrite is unavailable
+
+# --- Helper Function to parse the OK reply of a DOWNLOAD ---
+def parse_ok_response(response_msg, filename):
+    """
+    Parses "OK <filename> SIZE <size> PORT <port> [KEY VALUE]...".
+    Returns (file_size, data_port, options) or None if the message is not an OK for this file.
+    Raises ValueError if the size or port is not a number.
+    """
+    parts = response_msg.split()
+    options = parse_options(parts[6:]) if len(parts) >= 6 else None
+    if options is not None and parts[0] == "OK" and parts[1] == filename and parts[2] == "SIZE" and parts[4] == "PORT":
+        return int(parts[3]), int(parts[5]), options
+    return None
+
+# --- Helper Function to end a transfer with FILE CLOSE ---
+def close_transfer(data_transfer_socket, data_server_address, filename, rtt=None):
+    """Sends FILE CLOSE and waits for CLOSE_OK. Returns True if it arrived."""
+    close_request = f"FILE {filename} CLOSE"
+    final_response_data, _ = send_and_receive(data_transfer_socket, close_request, data_server_address, INITIAL_TIMEOUT, MAX_RETRIES, rtt)
+    # Late duplicates of DATA (replies to retransmitted REQs) may still be queued ahead of CLOSE_OK
+    while final_response_data is not None and (final_response_data[:1] == bytes([PACKET_MAGIC]) or final_response_data.startswith(b"DATA ")):
+        if rtt is not None:
+            rtt.metrics.duplicates += 1
+        try:
+            final_response_data, _ = data_transfer_socket.recvfrom(RECV_BUFFER_SIZE)
+        except socket.timeout:
+            final_response_data = None
+
+    if final_response_data is None:
+        logger.warning(f"Did not receive final CLOSE_OK for '{filename}'.")
+        return False
+    final_response_msg = final_response_data.decode('utf-8', errors='replace').strip()
+    if final_response_msg == f"FILE {filename} CLOSE_OK":
+        return True
+    logger.warning(f"Received unexpected final response: {final_response_msg[:80]}")
+    return False
+
+# --- Striped transfer: one file over several sessions at once ---
+def download_stripe(server_host, server_port, filename, proposals, f, file_size, chunk_range, journal=None,
+                    chunk_size=CHUNK_SIZE):
+    """
+    Negotiates its own DOWNLOAD session and fetches one stripe of the file into f.
+    Returns the number of bytes written, or None if no session could be opened (the server is
+    busy, for instance; there is no point waiting while the file's first session holds a slot).
+    """
+    rtt = RttEstimator(metrics=metrics_registry.open(f"{filename} stripe {chunk_range[0]}-{chunk_range[1]}"))
+    response_msg = request_download((server_host, server_port), filename, proposals, rtt, wait_if_busy=False)
+    ok = parse_ok_response(response_msg, filename) if response_msg is not None else None
+    # The stripe boundaries only make sense with the chunk size of the first session
+    if ok is None or ok[0] != file_size or int(ok[2].get('WINDOW', 1)) <= 1 or int(ok[2].get('CHUNK', CHUNK_SIZE)) != chunk_size:
+        logger.warning(f"Could not open a windowed session for a stripe of '{filename}': {response_msg}")
+        rtt.metrics.finish()
+        return None
+    _, data_port, options = ok
+    session_id = int(options['SESSION']) if options.get('FORMAT') == 'BINARY' else None
+    data_server_address = (server_host, data_port)
+    data_transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    window = tune_receive_buffer(data_transfer_socket, int(options['WINDOW']), chunk_size)
+    try:
+        bytes_written = download_windowed(data_transfer_socket, data_server_address, filename, f, file_size,
+                                          window, session_id, chunk_range, rtt, journal, chunk_size, negotiated_fec(options))
+        close_transfer(data_transfer_socket, data_server_address, filename, rtt)
+        return bytes_written
+    finally:
+        data_transfer_socket.close()
+        rtt.metrics.finish()
+
+def download_striped(server_host, server_port, filename, proposals, f, file_size, stripe_count,
+                     data_transfer_socket, data_server_address, window, session_id, rtt, journal=None,
+                     chunk_size=CHUNK_SIZE, fec=None):
+    """
+    Splits the file into `stripe_count` contiguous chunk ranges. The first stripe uses the session
+    that is already open; every other stripe runs in its own thread with its own DOWNLOAD/PORT
+    handshake, so the server serves them concurrently (on several cores with --workers).
+    Stripes write into the preallocated output file with positional writes. The range of a stripe
+    that gets no session of its own is fetched over the first session afterwards.
+    Returns the total number of bytes written.
+    """
+    chunk_count = math.ceil(file_size / chunk_size)
+    bounds = [chunk_count * stripe // stripe_count for stripe in range(stripe_count + 1)]
+    stripe_bytes = [0] * stripe_count
+
+    def run_stripe(stripe):
+        chunk_range = (bounds[stripe], bounds[stripe + 1])
+        stripe_bytes[stripe] = download_stripe(server_host, server_port, filename, proposals, f, file_size, chunk_range,
+                                               journal, chunk_size)
+
+    threads = [threading.Thread(target=run_stripe, args=(stripe,), daemon=True) for stripe in range(1, stripe_count)]
+    for thread in threads:
+        thread.start()
+    stripe_bytes[0] = download_windowed(data_transfer_socket, data_server_address, filename, f, file_size,
+                                        window, session_id, (bounds[0], bounds[1]), rtt, journal, chunk_size, fec)
+    for thread in threads:
+        thread.join()
+    for stripe in range(1, stripe_count):
+        if stripe_bytes[stripe] is None:
+            stripe_bytes[stripe] = download_windowed(data_transfer_socket, data_server_address, filename, f, file_size, window,
+                                                     session_id, (bounds[stripe], bounds[stripe + 1]), rtt, journal, chunk_size, fec)
+    return sum(stripe_bytes)
+
+# --- Download a single file ---
+def download_file(server_host, server_port, filename, proposals, stripes=1, resume=False):
+    """
+    Performs the DOWNLOAD handshake and the data transfer for one file.
+    Uses its own handshake and data sockets, so several downloads can run at once.
+    Windowed transfers keep a journal of the completed ranges next to the file until it is
+    complete; with `resume` a matching journal is picked up and only the missing chunks are fetched.
+    Returns a result dict: filename, status ('ok', 'not_found', 'no_response', 'busy', 'incomplete',
+    'corrupt' or 'error'), bytes on disk, file size (None if unknown) and elapsed seconds.
+    """
+    started = time.monotonic()
+    result = {'filename': filename, 'status': 'error', 'bytes': 0, 'size': None, 'seconds': 0.0}
+    server_address = (server_host, server_port)
+    rtt = RttEstimator(metrics=metrics_registry.open(filename)) # Per-session RTT state and metrics, seeded by the handshake
+    response_msg = request_download(server_address, filename, proposals, rtt)
+
+    if response_msg is None:
+        logger.error(f"Failed to get DOWNLOAD response for '{filename}'. Skipping to next file.")
+        result['status'] = 'no_response'
+        rtt.metrics.finish()
+        result['seconds'] = time.monotonic() - started
+        return result
+
+    parts = response_msg.split()
+    try:
+        ok = parse_ok_response(response_msg, filename)
+    except ValueError as e:
+        logger.error(f"Error parsing server OK response: {e}. Response was: {response_msg[:80]}")
+        rtt.metrics.finish()
+        result['seconds'] = time.monotonic() - started
+        return result
+
+    if ok is not None:
+        try:
+            file_size, data_port, options = ok
+            result['size'] = file_size
+            # The server echoes WINDOW only if it supports the windowed protocol
+            negotiated_window = int(options.get('WINDOW', 1))
+            # ...and FORMAT BINARY with a SESSION id only if it will frame DATA in binary
+            session_id = int(options['SESSION']) if options.get('FORMAT') == 'BINARY' else None
+            # The whole-file digest, if the server accepted CHECKSUM and has hashed the file
+            expected_digest = options.get('DIGEST')
+            # The chunk size, as the server clamped it; servers without CHUNK support keep the legacy size
+            chunk_size = int(options.get('CHUNK', CHUNK_SIZE))
+            # Parity packets per group of chunks, if the server accepted FEC
+            fec = negotiated_fec(options)
+            logger.info(f"Server confirms OK for '{filename}'. Size: {file_size} bytes, Data Port: {data_port}"
+                        f"{', Window: ' + str(negotiated_window) if negotiated_window > 1 else ''}"
+                        f"{', Chunk: ' + str(chunk_size) if chunk_size != CHUNK_SIZE else ''}"
+                        f"{', Format: binary' if session_id is not None else ''}"
+                        f"{', FEC: %d+%d' % fec if fec is not None else ''}")
+
+            # Step 2: Initiate file transfer on the new data port
+            data_server_address = (server_host, data_port)
+            # Create a new socket for data transfer for this file.
+            # This socket will be used for all chunk requests and responses for the current file.
+            data_transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # Client's data socket doesn't need to bind to a specific port for outgoing messages.
+            # It will automatically be assigned an ephemeral port.
+            if negotiated_window > 1:
+                window = tune_receive_buffer(data_transfer_socket, negotiated_window, chunk_size)
+                if window < negotiated_window:
+                    logger.info(f"Receive buffer holds only {window} chunks; limiting the window to that.")
+                    negotiated_window = window
+
+            output_file_path = os.path.join(CLIENT_FILES_DIR, filename)
+
+            # Stripes only pay off for large files, and need the windowed protocol
+            stripe_count = min(stripes, file_size // MIN_STRIPE_SIZE) if negotiated_window > 1 else 1
+
+            # Journals need the windowed protocol, which can fetch any set of chunks
+            journal, resuming = open_journal(output_file_path, file_size, expected_digest, resume) \
+                if negotiated_window > 1 else (None, False)
+            if resuming:
+                logger.info(f"Resuming '{filename}': {journal.completed_bytes()}/{file_size} bytes already on disk.")
+            elif journal is not None and 'DELTA' in options and os.path.isfile(output_file_path):
+                # An older copy is here: keep its chunks that still match, fetch the others
+                block_hashes = fetch_block_hashes(data_transfer_socket, data_server_address, session_id, file_size, chunk_size, rtt)
+                if block_hashes is not None:
+                    journal = open_delta_journal(output_file_path, file_size, expected_digest, chunk_size, block_hashes)
+                    resuming = True
+                    logger.info(f"Delta sync of '{filename}': {journal.completed_bytes()}/{file_size} bytes of the local copy match.")
+                else:
+                    logger.info(f"Fetching all of '{filename}' again.")
+            else:
+                logger.info(f"Created local file: {output_file_path}")
+
+            try:
+                with open(output_file_path, 'r+b' if resuming else 'wb') as f:
+                    if journal is not None:
+                        journal.file = f
+                    if negotiated_window > 1 and not resuming:
+                        # Chunks (and stripes) arrive in any order and are written at their own offset
+                        preallocate(f, file_size)
+                    try:
+                        if stripe_count > 1:
+                            logger.info(f"Striping '{filename}' over {stripe_count} sessions.")
+                            download_striped(server_host, server_port, filename, proposals, f, file_size, stripe_count,
+                                             data_transfer_socket, data_server_address, negotiated_window, session_id, rtt, journal,
+                                             chunk_size, fec)
+                        elif negotiated_window > 1:
+                            download_windowed(data_transfer_socket, data_server_address, filename, f, file_size, negotiated_window,
+                                              session_id, rtt=rtt, journal=journal, chunk_size=chunk_size, fec=fec)
+                        else:
+                            current_offset = download_stop_and_wait(data_transfer_socket, data_server_address, filename, f, file_size, rtt)
+                    except BaseException:
+                        # Whatever stopped the transfer, keep what reached the disk resumable
+                        if journal is not None:
+                            journal.save()
+                        raise
+                    if journal is not None:
+                        current_offset = journal.completed_bytes()
+                    elif negotiated_window > 1:
+                        current_offset = 0 # Nothing to fetch for a 0-byte file
+                    result['bytes'] = current_offset
+                    result['status'] = 'ok' if current_offset >= file_size else 'incomplete'
+
+                    # After the loop, send FILE CLOSE and wait for confirmation.
+                    # A windowed session stays open until we close it, even for a 0-byte file.
+                    if (file_size > 0 or negotiated_window > 1) and current_offset >= file_size:
+                        logger.debug("File data transfer loop finished successfully.")
+                        # Send final FILE CLOSE request
+                        if close_transfer(data_transfer_socket, data_server_address, filename, rtt):
+                            logger.info(f"Successfully downloaded '{filename}'. Received CLOSE_OK.")
+                    elif file_size == 0 and current_offset == 0:
+                        logger.info("File was 0 bytes, no data transfer needed. Treated as successful.")
+                        # For 0-byte files, we don't need to send CLOSE. Server likely sent CLOSE_OK immediately.
+                    else:
+                        logger.warning(f"Download of '{filename}' incomplete. Received {current_offset}/{file_size} bytes.")
+                        if journal is not None:
+                            journal.save()
+                            logger.info(f"Progress saved to '{journal.path}'; run again with --resume to fetch the rest.")
+
+                check_download(result, output_file_path, expected_digest, journal)
+
+            except FileNotFoundError:
+                logger.error(f"Could not create local file '{output_file_path}'. Check permissions or path.")
+            except Exception as e:
+                logger.error(f"An error occurred during file transfer for '{filename}': {e}")
+            finally:
+                data_transfer_socket.close() # Close the data transfer socket for this file
+                logger.debug(f"Data transfer socket for '{filename}' closed.")
+
+        except ValueError as e:
+            logger.error(f"Error parsing server OK response: {e}. Response was: {response_msg[:80]}")
+        except Exception as e:
+            logger.error(f"An unexpected error occurred after receiving OK response for '{filename}': {e}")
+
+    elif len(parts) == 3 and parts[0] == "ERR" and parts[1] == filename and parts[2] == "NOT_FOUND":
+        logger.warning(f"Server reported '{filename}' NOT_FOUND. Skipping to next file.")
+        result['status'] = 'not_found'
+    elif parts[:1] == ["BUSY"]:
+        logger.error(f"Server still busy after {BUSY_WAIT_LIMIT:.0f}s. Skipping '{filename}'.")
+        result['status'] = 'busy'
+    else:
+        logger.error(f"Received unexpected initial response from server: {response_msg[:80]}. Skipping to next file.")
+
+    rtt.metrics.finish()
+    result['seconds'] = time.monotonic() - started
+    return result
+
+# --- Batch transfer: many files over one handshake and one data channel ---
+def split_batches(filenames):
+    """Splits the file list into DOWNLOAD_MANY batches of at most MANY_BATCH_FILES names and MANY_REQUEST_LIMIT bytes."""
+    batches, batch, batch_bytes = [], [], 0
+    for filename in filenames:
+        if batch and (len(batch) == MANY_BATCH_FILES or batch_bytes + len(filename) + 1 > MANY_REQUEST_LIMIT):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(filename)
+        batch_bytes += len(filename) + 1
+    if batch:
+        batches.append(batch)
+    return batches
+
+def request_download_many(server_address, filenames, proposals, rtt=None):
+    """
+    Sends "DOWNLOAD_MANY [KEY VALUE]... FILES <filename>..." from a fresh handshake socket.
+    Returns the decoded reply, or None if the server never answered (servers without batch
+    support ignore the request).
+    """
+    download_request = "DOWNLOAD_MANY" + ''.join(f" {key} {value}" for key, value in proposals.items())
+    download_request += " FILES " + ' '.join(filenames)
+    handshake_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    handshake_socket.bind(('', 0))
+    try:
+        give_up_at = time.monotonic() + BUSY_WAIT_LIMIT
+        attempt = 0
+        while True:
+            response_data, _ = send_and_receive(handshake_socket, download_request, server_address, INITIAL_TIMEOUT, NEGOTIATION_RETRIES, rtt)
+            delay = busy_delay(response_data, attempt)
+            if delay is None or time.monotonic() + delay > give_up_at:
+                break
+            logger.info(f"Server busy; asking again for a batch of {len(filenames)} files in {delay:.1f}s.")
+            time.sleep(delay)
+            attempt += 1
+    finally:
+        handshake_socket.close()
+    if response_data is None:
+        return None
+    return response_data.decode('utf-8', errors='replace')
+
+def parse_many_response(response_msg):
+    """
+    Parses the DOWNLOAD_MANY reply: "OK_MANY PORT <port> [KEY VALUE]..." and then one line per file,
+    "<filename> NOT_FOUND" or "<filename> <size> [KEY VALUE]..." (ID, INLINE, DIGEST).
+    Returns (data_port, options, entries) with entries mapping each listed filename to
+    (size, file_options), size None if not found; or None if the reply is not an OK_MANY.
+    Raises ValueError if a number or an entry cannot be parsed.
+    """
+    lines = response_msg.split('\n')
+    header = lines[0].split()
+    options = parse_options(header[3:]) if len(header) >= 3 else None
+    if options is None or header[0] != "OK_MANY" or header[1] != "PORT":
+        return None
+    entries = {}
+    for line in lines[1:]:
+        parts = line.split()
+        if len(parts) == 2 and parts[1] == "NOT_FOUND":
+            entries[parts[0]] = (None, {})
+        elif len(parts) >= 2:
+            file_options = parse_options(parts[2:])
+            if file_options is None:
+                raise ValueError(f"malformed entry '{line[:80]}'")
+            entries[parts[0]] = (int(parts[1]), file_options)
+    return int(header[2]), options, entries
+
+def receive_batch(server_host, data_port, options, entries, filenames, rtt, resume, started):
+    """
+    Stores the inline files of a DOWNLOAD_MANY reply and fetches all others together: their
+    chunk requests share one window and one data socket, multiplexed by file id. Ends with a
+    single CLOSE_MANY for all of them.
+    Returns a dict of result dicts by filename.
+    """
+    window = int(options['WINDOW'])
+    chunk_size = int(options.get('CHUNK', CHUNK_SIZE))
+    results = {}
+    targets = []
+    try:
+        for filename in filenames:
+            file_size, file_options = entries[filename]
+            result = {'filename': filename, 'status': 'error', 'bytes': 0, 'size': file_size, 'seconds': 0.0}
+            results[filename] = result
+            output_file_path = os.path.join(CLIENT_FILES_DIR, filename)
+            try:
+                if file_size is None:
+                    logger.warning(f"Server reported '{filename}' NOT_FOUND. Skipping.")
+                    result['status'] = 'not_found'
+                elif 'ID' in file_options:
+                    journal, resuming = open_journal(output_file_path, file_size, file_options.get('DIGEST'), resume)
+                    f = open(output_file_path, 'r+b' if resuming else 'wb')
+                    journal.file = f
+                    if not resuming:
+                        preallocate(f, file_size)
+                    targets.append(ChunkTarget(filename, f, file_size, int(file_options['ID']), journal, chunk_size=chunk_size))
+                else:
+                    # Small enough to have come inline with the reply (nothing at all for an empty file)
+                    decoded_file = base64.b64decode(file_options.get('INLINE', ''))
+                    with open(output_file_path, 'wb') as f:
+                        f.write(decoded_file)
+                    result['bytes'] = len(decoded_file)
+                    result['status'] = 'ok' if len(decoded_file) == file_size else 'incomplete'
+                    result['seconds'] = time.monotonic() - started
+                    check_download(result, output_file_path, file_options.get('DIGEST'))
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not store '{filename}': {e}")
+
+        if targets:
+            logger.info(f"Fetching {len(targets)} files over data port {data_port}.")
+            data_server_address = (server_host, data_port)
+            data_transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                window = tune_receive_buffer(data_transfer_socket, window, chunk_size)
+                try:
+                    download_chunks(data_transfer_socket, data_server_address, targets, window, rtt, chunk_size,
+                                    negotiated_fec(options))
+                except BaseException:
+                    # Whatever stopped the transfer, keep what reached the disk resumable
+                    for target in targets:
+                        target.journal.save()
+                    raise
+                # One message ends every session of the batch, finished or not
+                close_request = "CLOSE_MANY " + ' '.join(str(target.session_id) for target in targets)
+                final_response_data, _ = send_and_receive(data_transfer_socket, close_request, data_server_address,
+                                                          INITIAL_TIMEOUT, MAX_RETRIES, rtt)
+                if final_response_data != b"CLOSE_MANY_OK":
+                    logger.warning("Did not receive CLOSE_MANY_OK for the batch.")
+            finally:
+                data_transfer_socket.close()
+
+            for target in targets:
+                result = results[target.filename]
+                result['bytes'] = target.journal.completed_bytes()
+                result['status'] = 'ok' if result['bytes'] >= target.file_size else 'incomplete'
+                result['seconds'] = time.monotonic() - started
+                if result['status'] == 'incomplete':
+                    target.journal.save()
+                    logger.warning(f"Download of '{target.filename}' incomplete. Received {result['bytes']}/{target.file_size} bytes.")
+    finally:
+        for target in targets:
+            target.f.close()
+    for target in targets:
+        check_download(results[target.filename], os.path.join(CLIENT_FILES_DIR, target.filename),
+                       entries[target.filename][1].get('DIGEST'), target.journal)
+    return results
+
+def download_many(server_host, server_port, filenames, proposals, resume=False):
+    """
+    Downloads a batch of files with one DOWNLOAD_MANY handshake instead of one DOWNLOAD (and one
+    pair of sockets) per file. Files the reply had no room for are asked for again; if the server
+    does not support batches, the files are downloaded one by one with download_file instead.
+    Returns the result dicts in the order of `filenames`.
+    """
     server_address = (server_host, server_port)
+    # Shared by the handshakes and the data channel of every round
+    rtt = RttEstimator(metrics=metrics_registry.open(f"batch of {len(filenames)} files from {filenames[0]}"))
+    results = {}
+    remaining = list(filenames)
+    while remaining:
+        started = time.monotonic()
+        response_msg = request_download_many(server_address, remaining, proposals, rtt)
+        if response_msg is not None and response_msg.startswith("BUSY "):
+            logger.error(f"Server still busy after {BUSY_WAIT_LIMIT:.0f}s. Skipping {len(remaining)} files.")
+            for filename in remaining:
+                results[filename] = {'filename': filename, 'status': 'busy', 'bytes': 0, 'size': None,
+                                     'seconds': time.monotonic() - started}
+            break
+        try:
+            many = parse_many_response(response_msg) if response_msg is not None else None
+        except ValueError as e:
+            logger.error(f"Error parsing DOWNLOAD_MANY reply: {e}")
+            many = None
+        listed = [filename for filename in remaining if many is not None and filename in many[2]]
+        if not listed:
+            logger.warning(f"No batch support on the server ({(response_msg or 'no answer').splitlines()[0][:80]}). "
+                           f"Downloading {len(remaining)} files one by one.")
+            for filename in remaining:
+                results[filename] = download_file(server_host, server_port, filename, proposals, resume=resume)
+            break
+        data_port, options, entries = many
+        logger.info(f"Server answered DOWNLOAD_MANY for {len(listed)}/{len(remaining)} files.")
+        results.update(receive_batch(server_host, data_port, options, entries, listed, rtt, resume, started))
+        remaining = [filename for filename in remaining if filename not in entries]
+    rtt.metrics.finish()
+    return [results[filename] for filename in filenames]
+
+# --- Helper Function to print the per-file result summary ---
+def print_summary(results, elapsed):
+    print("\n--- Download summary ---")
+    for result in results:
+        size = '?' if result['size'] is None else result['size']
+        print(f"{result['filename']:<40} {result['status']:<12} {result['bytes']}/{size} bytes in {result['seconds']:.2f}s")
+    succeeded = sum(1 for result in results if result['status'] == 'ok')
+    total_bytes = sum(result['bytes'] for result in results)
+    print(f"{succeeded}/{len(results)} files downloaded, {total_bytes} bytes in {elapsed:.2f}s.")
+
+# --- Metrics dump and server statistics ---
+def query_server_stats(server_host, server_port):
+    """Sends STATS to the main server port. Returns the server's statistics as a dict, or None."""
+    stats_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        response_data, _ = send_and_receive(stats_socket, "STATS", (server_host, server_port), INITIAL_TIMEOUT, NEGOTIATION_RETRIES)
+    finally:
+        stats_socket.close()
+    if response_data is None or not response_data.startswith(b"STATS "):
+        logger.warning("The server did not answer STATS.")
+        return None
+    try:
+        return json.loads(response_data[len(b"STATS "):])
+    except ValueError as e:
+        logger.warning(f"Could not parse the STATS reply: {e}")
+        return None
+
+def write_stats_json(path, results, server_stats=None):
+    """Writes the per-file results and the metrics of every session as JSON to `path` ('-' for stdout)."""
+    stats = {'results': results or [], **metrics_registry.snapshot()}
+    if server_stats is not None:
+        stats['server'] = server_stats
+    text = json.dumps(stats, indent=2)
+    if path == '-':
+        print(text)
+    else:
+        with open(path, 'w') as stats_file:
+            stats_file.write(text + '\n')
+        logger.info(f"Wrote transfer statistics to '{path}'.")
+
+# --- Main Client Logic ---
+def run_client(server_host, server_port, files_list_path, proposals=None, parallel=1, stripes=1, resume=False, batch=False):
+    if proposals is None:
+        proposals = build_proposals(DEFAULT_WINDOW, binary=True, chunk_size=DEFAULT_CHUNK_SIZE)
+    ensure_dir(CLIENT_FILES_DIR) # Ensure the client_files directory exists
 
     # Read files to download
     files_to_download = []
@@ -76,181 +1647,116 @@ def run_client(server_host, server_port, files_list_path):
         print("No files listed in files.txt to download. Exiting.")
         sys.exit(0)
 
-    print(f"Starting download of {len(files_to_download)} files from {server_host}:{server_port}")
-
-    for filename in files_to_download:
-        print(f"\n--- Attempting to download: {filename} ---")
-        
-        # --- MODIFICATION START ---
-        # Create a new socket for *each* initial DOWNLOAD handshake.
-        # This isolates responses for each file, preventing old messages from interfering.
-        initial_handshake_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # Bind to a random available port to ensure a clean slate for this specific handshake.
-        initial_handshake_socket.bind(('', 0)) 
-        # --- MODIFICATION END ---
-
-        # Step 1: Send DOWNLOAD request to main server port
-        download_request = f"DOWNLOAD {filename}"
-        
-        # Use the NEWLY created initial_handshake_socket for this specific download request
-        response_data, _ = send_and_receive(initial_handshake_socket, download_request, server_address, INITIAL_TIMEOUT, MAX_RETRIES)
-
-        # --- MODIFICATION START ---
-        # Close the socket immediately after getting the response for this handshake.
-        initial_handshake_socket.close() 
-        # --- MODIFICATION END ---
+    logger.info(f"Starting download of {len(files_to_download)} files from {server_host}:{server_port}")
+    started = time.monotonic()
 
-        if response_data is None:
-            print(f"Failed to get DOWNLOAD response for '{filename}'. Skipping to next file.")
-            continue # Move to next file
-        
-        response_msg = response_data.decode('utf-8').strip()
-        parts = response_msg.split()
+    if batch and proposals.get('FORMAT') == 'BINARY':
+        # Batches multiplex their files by session id, which needs the binary windowed protocol
+        batches = split_batches(files_to_download)
+        logger.info(f"Downloading in {len(batches)} DOWNLOAD_MANY batches, up to {parallel} at once.")
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = [result for batch_results in executor.map(
+                           lambda batch_files: download_many(server_host, server_port, batch_files, proposals, resume), batches)
+                       for result in batch_results]
+    elif parallel > 1:
+        # Every download uses its own sockets and state, so they only share the thread pool
+        logger.info(f"Downloading up to {parallel} files at once.")
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(lambda filename: download_file(server_host, server_port, filename, proposals, stripes, resume),
+                                        files_to_download))
+    else:
+        results = []
+        for filename in files_to_download:
+            logger.info(f"--- Attempting to download: {filename} ---")
+            results.append(download_file(server_host, server_port, filename, proposals, stripes, resume))
 
-        if len(parts) == 6 and parts[0] == "OK" and parts[1] == filename and parts[2] == "SIZE" and parts[4] == "PORT":
-            try:
-                file_size = int(parts[3])
-                data_port = int(parts[5])
-                print(f"Server confirms OK for '{filename}'. Size: {file_size} bytes, Data Port: {data_port}")
-
-                # Step 2: Initiate file transfer on the new data port
-                data_server_address = (server_host, data_port)
-                # Create a new socket for data transfer for this file.
-                # This socket will be used for all chunk requests and responses for the current file.
-                data_transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                # Client's data socket doesn't need to bind to a specific port for outgoing messages.
-                # It will automatically be assigned an ephemeral port.
-                
-                output_file_path = os.path.join(CLIENT_FILES_DIR, filename)
-                current_offset = 0
-                
-                print(f"Created local file: {output_file_path}")
-                print("Download Progress: ", end='', flush=True)
-
-                try:
-                    with open(output_file_path, 'wb') as f:
-                        while current_offset < file_size:
-                            # Calculate the end byte for the current chunk
-                            chunk_end_byte = min(current_offset + CHUNK_SIZE - 1, file_size - 1)
-                            
-                            # Handle case of 0-byte file (file_size=0) or last chunk where no more data
-                            if file_size == 0 or chunk_end_byte < current_offset: 
-                                break 
-                            
-                            # Send REQ for the next chunk
-                            chunk_request = f"REQ {filename} START {current_offset} END {chunk_end_byte}"
-                            chunk_response_data, _ = send_and_receive(data_transfer_socket, chunk_request, data_server_address, INITIAL_TIMEOUT, MAX_RETRIES)
-
-                            if chunk_response_data is None:
-                                print(f"\nFailed to receive chunk for offset {current_offset}. Aborting download of '{filename}'.")
-                                break # Break from inner while loop
-
-                            chunk_response_msg = chunk_response_data.decode('utf-8').strip()
-                            chunk_parts = chunk_response_msg.split(' ', 5) # Split into 5 parts, the last one being the base64 data
-
-                            if len(chunk_parts) == 6 and chunk_parts[0] == "DATA" and \
-                               chunk_parts[1] == filename and chunk_parts[2] == "START" and \
-                               chunk_parts[4] == "END":
-                                
-                                try:
-                                    received_start_byte = int(chunk_parts[3])
-                                    # The last part includes "END <end_byte> <base64_data>"
-                                    # We need to split that again to get just the end_byte
-                                    end_byte_str, encoded_chunk = chunk_parts[5].split(' ', 1) 
-                                    received_end_byte = int(end_byte_str)
-                                except ValueError:
-                                    print(f"\nError parsing chunk start/end bytes for '{filename}'. Skipping this chunk.")
-                                    continue # Skip to next iteration, possibly re-requesting same chunk
-
-                                if received_start_byte == current_offset:
-                                    try:
-                                        decoded_chunk = base64.b64decode(encoded_chunk)
-                                        # Ensure we don't write beyond file size if chunk is malformed
-                                        if current_offset + len(decoded_chunk) > file_size:
-                                            decoded_chunk = decoded_chunk[:file_size - current_offset] # Truncate if too long
-                                        
-                                        f.seek(current_offset) # Seek to the correct position
-                                        f.write(decoded_chunk)
-                                        current_offset += len(decoded_chunk)
-                                        print("*", end='', flush=True) # Print progress indicator
-                                    except Exception as e:
-                                        print(f"\nError decoding or writing chunk for '{filename}': {e}. Skipping this chunk.")
-                                else:
-                                    print(f"\nWarning: Received out-of-order chunk for '{filename}'. Expected offset {current_offset}, got {received_start_byte}. Retrying current chunk.")
-                                    # If out-of-order, don't advance offset. Next iteration will re-request current_offset.
-                            elif chunk_parts[0] == "FILE" and chunk_parts[1] == filename and chunk_parts[2] == "CLOSE_OK":
-                                # This can happen if the server already finished sending and client was late with a REQ
-                                # or if the file was very small and server sent CLOSE_OK immediately after the only chunk.
-                                print("\nServer sent CLOSE_OK prematurely (or file was fully downloaded).")
-                                break # Exit the chunk loop if server says it's done
-                            elif chunk_parts[0] == "ERR" and chunk_parts[1] == filename and chunk_parts[2] == "NOT_FOUND":
-                                print(f"\nServer reported '{filename}' not found during data transfer. Aborting.")
-                                break
-                            else:
-                                print(f"\nReceived unexpected data packet format for '{filename}': {chunk_response_msg}")
-                                # Decide whether to retry or abort
-                                break # Abort for now
-
-                        # After the loop, send FILE CLOSE and wait for confirmation
-                        # Only send if we managed to initiate download and not if the file size was 0
-                        if file_size > 0 and current_offset >= file_size: 
-                            print("\nFile data transfer loop finished successfully.")
-                            # Send final FILE CLOSE request
-                            close_request = f"FILE {filename} CLOSE"
-                            final_response_data, _ = send_and_receive(data_transfer_socket, close_request, data_server_address, INITIAL_TIMEOUT, MAX_RETRIES)
-
-                            if final_response_data is None:
-                                print(f"Warning: Did not receive final CLOSE_OK for '{filename}'.")
-                            else:
-                                final_response_msg = final_response_data.decode('utf-8').strip()
-                                if final_response_msg == f"FILE {filename} CLOSE_OK":
-                                    print(f"Successfully downloaded '{filename}'. Received CLOSE_OK.")
-                                else:
-                                    print(f"Received unexpected final response: {final_response_msg}")
-                        elif file_size == 0 and current_offset == 0:
-                            print("\nFile was 0 bytes, no data transfer needed. Treated as successful.")
-                            # For 0-byte files, we don't need to send CLOSE. Server likely sent CLOSE_OK immediately.
-                        else:
-                            print(f"\nDownload of '{filename}' incomplete. Received {current_offset}/{file_size} bytes.")
-
-                except FileNotFoundError:
-                    print(f"\nError: Could not create local file '{output_file_path}'. Check permissions or path.")
-                except Exception as e:
-                    print(f"\nAn error occurred during file transfer for '{filename}': {e}")
-                finally:
-                    data_transfer_socket.close() # Close the data transfer socket for this file
-                    print(f"Data transfer socket for '{filename}' closed.")
-
-            except ValueError as e:
-                print(f"Error parsing server OK response: {e}. Response was: {response_msg}")
-            except Exception as e:
-                print(f"An unexpected error occurred after receiving OK response for '{filename}': {e}")
-
-        elif len(parts) == 3 and parts[0] == "ERR" and parts[1] == filename and parts[2] == "NOT_FOUND":
-            print(f"Server reported '{filename}' NOT_FOUND. Skipping to next file.")
-        else:
-            print(f"Received unexpected initial response from server: {response_msg}. Skipping to next file.")
-            
-    print("\nAll downloads attempted. Client exiting.")
+    print_summary(results, time.monotonic() - started)
+    logger.info("All downloads attempted. Client exiting.")
+    return results
 
 # --- Entry Point ---
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: python3 UDPClient.py <server_hostname> <server_port_number> <files_list.txt>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(prog="UDPClient.py", description="Download the files listed in a file list from a UDP file server.")
+    parser.add_argument("server_hostname")
+    parser.add_argument("server_port_number")
+    parser.add_argument("files_list")
+    parser.add_argument("--window", type=int, default=DEFAULT_WINDOW,
+                        help=f"chunk requests kept in flight; 1 forces the legacy stop-and-wait protocol (default {DEFAULT_WINDOW})")
+    parser.add_argument("--text", action="store_true",
+                        help="do not propose the binary DATA format; keep base64 text packets")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="number of files downloaded at the same time (default 1)")
+    parser.add_argument("--stripes", type=int, default=1,
+                        help=f"split each file of at least 2 x {MIN_STRIPE_SIZE} bytes into up to this many byte ranges "
+                             "downloaded over separate sessions at once (default 1)")
+    parser.add_argument("--chunk-size", default=str(DEFAULT_CHUNK_SIZE),
+                        help=f"bytes per chunk proposed to the server, or 'mtu' to fit the path MTU "
+                             f"(default {DEFAULT_CHUNK_SIZE}; the legacy protocol always uses {CHUNK_SIZE})")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue interrupted downloads from their journal instead of starting over")
+    parser.add_argument("--batch", action="store_true",
+                        help=f"ask for up to {MANY_BATCH_FILES} files per DOWNLOAD_MANY handshake and fetch them over one "
+                             "data channel (binary windowed protocol only; stripes are not used)")
+    parser.add_argument("--fec", metavar="K[:R]",
+                        help="ask for R XOR parity packets (default 1) after every K chunks, so up to R lost chunks "
+                             "of a group are rebuilt without waiting for a retransmission (binary windowed protocol only)")
+    parser.add_argument("--delta", action="store_true",
+                        help="when an older copy of a file is in client_files, compare it chunk by chunk with the server's "
+                             "block hashes and fetch only the chunks that differ (binary windowed protocol only)")
+    parser.add_argument("--no-checksum", action="store_true",
+                        help="do not ask for per-chunk CRC32 and the whole-file digest")
+    parser.add_argument("--stats-json", metavar="PATH",
+                        help="on exit, write per-file results and per-session metrics (bytes, requests, retransmits, "
+                             "RTT histogram, throughput) as JSON to PATH, or '-' for stdout")
+    parser.add_argument("--server-stats", action="store_true",
+                        help="on exit, also ask the server for its STATS and add them to --stats-json (or print them)")
+    parser.add_argument("--log-level", choices=['debug', 'info', 'warning', 'error'], default='info',
+                        help="least severe messages to print (default info)")
+    parser.add_argument("--log-rate", type=int, default=LOG_RATE,
+                        help=f"max log lines per second from one place in the code, 0 for no limit (default {LOG_RATE})")
+    args = parser.parse_args()
+    configure_logging(args.log_level, args.log_rate)
 
-    SERVER_HOST = sys.argv[1]
+    SERVER_HOST = args.server_hostname
     try:
-        SERVER_PORT = int(sys.argv[2])
+        SERVER_PORT = int(args.server_port_number)
         if not (1024 <= SERVER_PORT <= 65535):
             raise ValueError("Server port number must be between 1024 and 65535.")
+        if args.window < 1:
+            raise ValueError("Window must be at least 1.")
+        if args.parallel < 1:
+            raise ValueError("Parallel downloads must be at least 1.")
+        if args.stripes < 1:
+            raise ValueError("Stripes must be at least 1.")
+        if args.chunk_size == 'mtu':
+            CHUNK_SIZE_PROPOSAL = probe_chunk_size(SERVER_HOST, SERVER_PORT, binary=not args.text)
+        else:
+            CHUNK_SIZE_PROPOSAL = int(args.chunk_size)
+            if not (1 <= CHUNK_SIZE_PROPOSAL <= MAX_CHUNK_SIZE):
+                raise ValueError(f"Chunk size must be between 1 and {MAX_CHUNK_SIZE}.")
+        FEC_PROPOSAL = None
+        if args.fec is not None:
+            group, _, parity_count = args.fec.partition(':')
+            FEC_PROPOSAL = (int(group), int(parity_count or 1))
+            if FEC_PROPOSAL[0] < 2 or FEC_PROPOSAL[1] < 1:
+                raise ValueError("FEC needs a group of at least 2 chunks and at least 1 parity packet.")
     except ValueError as e:
-        print(f"Error: Invalid server port number. {e}")
+        print(f"Error: Invalid argument. {e}")
         sys.exit(1)
     
-    FILES_LIST_PATH = sys.argv[3]
-
-    print(f"UDP Client starting. Target server: {SERVER_HOST}:{SERVER_PORT} with file list {FILES_LIST_PATH}")
+    FILES_LIST_PATH = args.files_list
 
-    run_client(SERVER_HOST, SERVER_PORT, FILES_LIST_PATH)
+    logger.info(f"UDP Client starting. Target server: {SERVER_HOST}:{SERVER_PORT} with file list {FILES_LIST_PATH}")
 
+    results = None
+    try:
+        results = run_client(SERVER_HOST, SERVER_PORT, FILES_LIST_PATH, build_proposals(args.window, binary=not args.text, checksum=not args.no_checksum, chunk_size=CHUNK_SIZE_PROPOSAL,
+                                                                                  fec=FEC_PROPOSAL, delta=args.delta),
+                             args.parallel, args.stripes, args.resume, args.batch)
+    finally:
+        # Also after Ctrl+C: the metrics of an interrupted run are the interesting ones
+        server_stats = query_server_stats(SERVER_HOST, SERVER_PORT) if args.server_stats else None
+        if args.stats_json:
+            write_stats_json(args.stats_json, results, server_stats)
+        elif server_stats is not None:
+            print(json.dumps(server_stats, indent=2))
@@ -1,182 +1,1842 @@
+import argparse
+import selectors
 import socket
 import threading
 import os
 import base64
+import bisect
+import hashlib
+import heapq
+import itertools
+import json
+import logging
 import math
+import mmap
 import time
 import sys
+import random
+import signal
+import stat
+import struct
+import zlib
+import multiprocessing
+from collections import OrderedDict, deque
+from multiprocessing.connection import wait as wait_for_processes
+
+try:
+    import resource # Unix only; used to report peak memory use
+except ImportError:
+    resource = None
 
 # --- Configuration ---
 SERVER_HOST = '0.0.0.0' # Listen on all available interfaces
-CHUNK_SIZE = 1000       # Bytes of raw data per chunk
+CHUNK_SIZE = 1000       # Bytes of raw data per chunk, unless the client negotiates 'CHUNK'
+MIN_CHUNK_SIZE = 512    # Smallest chunk size a client may negotiate
+MAX_CHUNK_SIZE = 65000  # Largest binary chunk: header + payload must fit a 65507-byte UDP datagram
+MAX_TEXT_CHUNK_SIZE = 48000 # Largest text chunk: base64 grows it by 4/3, plus the DATA line
+SOCKET_BUFFER_SIZE = 8 * 1024 * 1024 # SO_SNDBUF/SO_RCVBUF asked for on data sockets (the kernel may clamp it)
+REQUEST_BUFFER_SIZE = 65536 # recvfrom() size for client messages (a DOWNLOAD_MANY can be large)
+INLINE_LIMIT = 1024     # Files up to this size are sent inside the DOWNLOAD_MANY reply itself
+MAX_REPLY_SIZE = 60000  # Longest DOWNLOAD_MANY reply; files that do not fit are left for the next request
 MAX_RETRIES = 5         # Max retransmission attempts for client
 INITIAL_TIMEOUT = 1     # Initial timeout for client's stop-and-wait
+MAX_WINDOW = 256        # Upper bound on chunk requests a windowed client may keep in flight
+MAX_FEC_GROUP = 64      # Most chunks covered by the parity packets of one FEC group
+MAX_FEC_PARITY = 8      # Most parity packets per FEC group
+
+# --- Binary wire format (negotiated with 'FORMAT BINARY') ---
+# Every binary packet starts with a fixed header followed by raw payload bytes:
+# magic, packet type, flags, session id, byte offset, payload length, payload CRC32.
+PACKET_HEADER = struct.Struct('!BBHIQII')
+PACKET_MAGIC = 0xB7     # Never a valid first byte of a text (ASCII) message
+PKT_REQ = 1             # Client -> server: send `length` bytes starting at `offset` (no payload)
+PKT_DATA = 2            # Server -> client: raw chunk bytes for `offset`
+PKT_PARITY = 3          # Server -> client: XOR parity of an FEC subset whose first chunk is at `offset`
+PKT_HASH_REQ = 4        # Client -> server: send the block hashes of the chunks covering `length` bytes at `offset`
+PKT_HASHES = 5          # Server -> client: block hashes of consecutive chunks from `offset` (none yet: still hashing)
+FLAG_LAST_CHUNK = 0x1   # Set on the DATA packet that reaches the end of the file
+FLAG_CRC = 0x2          # The CRC32 field is valid (negotiated with 'CHECKSUM CRC32')
+BLOCK_HASH_HEADER = struct.Struct('!QQ') # File size and mtime_ns in front of a stored block hash list
+
+MAX_SESSIONS = 256      # Default cap on transfer sessions open at once (per process); 0 for no cap
+SESSION_IDLE_TIMEOUT = 30.0 # Default time without a packet from the client after which a session is closed (seconds)
+REAP_INTERVAL = 1.0     # How often the event loop looks for idle sessions (seconds)
+BUSY_RETRY_AFTER = 1.0  # Retry hint sent with BUSY when the session cap is reached (seconds)
+PACING_BURST = 0.1      # Send-rate buckets hold this many seconds' worth of bytes
+PACING_MIN_BURST = 65507 # ...but at least one largest UDP datagram, so any packet can be sent at any rate
+MAX_PACING_DELAY = 0.1  # Packets queued behind more than this much backlog are dropped instead (seconds)
+PACING_TICK = 0.001     # Shortest wait for the next held back packet to become due (seconds)
+PACER_MAX_CLIENTS = 4096 # Per-client buckets kept before idle (full) ones are pruned
+
+WORKER_MIN_UPTIME = 1.0 # A worker that dies sooner than this is restarted only after a pause (seconds)
+WORKER_RESTART_DELAY = 1.0 # Pause before restarting a worker that keeps crashing (seconds)
+CACHE_BUDGET_MB = 256  # Default byte budget for memory-mapped files kept by the file cache
+CACHE_STAT_TTL = 1.0    # How long a cached stat() result is trusted before re-checking (seconds)
+CACHE_STAT_ENTRIES = 4096 # Files whose stat() result is cached, least recently used dropped first
+DIGEST_BLOCK_SIZE = 1024 * 1024 # Read size when computing whole-file digests
+DIGEST_SYNC_LIMIT = 64 * 1024 * 1024 # Larger files are hashed in the background (no DIGEST in OK until done)
+EVENTLOOP_DIGEST_SYNC_LIMIT = 1024 * 1024 # The same limit for the event loop, which stalls every session while it hashes
+BLOCK_HASH_ALGORITHM = 'BLAKE2B-128' # Per-chunk hash offered for delta sync with 'DELTA'
+BLOCK_HASH_SIZE = 16    # Bytes per block hash (BLAKE2b with a 128-bit digest)
+HASHES_PER_PACKET = 2048 # Most block hashes in one PKT_HASHES packet
+BLOCK_HASH_CACHE_FILES = 32 # Block hash lists kept in memory; all of them are also kept in BLOCK_HASH_DIR
+LOG_FORMAT = '%(asctime)s %(levelname)s [%(process)d] %(message)s'
+LOG_RATE = 20           # Default max log lines per second from one place in the code; the rest are counted
+MAX_FINISHED_SESSIONS = 200 # Finished sessions whose metrics are kept for STATS
+STATS_MAX_SESSIONS = 50 # Most sessions listed in one STATS reply (fewer if the reply would not fit a datagram)
+FIRST_REQUEST_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000) # Upper bounds of the OK-to-first-REQ histogram buckets
 FILES_DIR = 'files'     # Directory where files are stored on server
+BLOCK_HASH_DIR = 'block_hashes' # Next to FILES_DIR: block hashes computed for delta sync, reused across restarts
 CLIENT_FILES_DIR = 'client_files' # Not used by server, but good to define if needed later
 
+# --- Logging ---
+logger = logging.getLogger('udpserver')
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `rate` records per second through from each place in the code (file and line),
+    so a flood of identical warnings cannot slow the transfers down. The number of records dropped
+    is appended to the next record from that place that gets through. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.lock = threading.Lock()
+        self.windows = {} # (pathname, lineno) -> [window start, records let through, records dropped]
+
+    def filter(self, record):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            window = self.windows.get(key)
+            if window is None or now - window[0] >= 1.0:
+                dropped = window[2] if window is not None else 0
+                self.windows[key] = [now, 1, 0]
+            elif window[1] < self.rate:
+                window[1] += 1
+                dropped, window[2] = window[2], 0
+            else:
+                window[2] += 1
+                return False
+        if dropped:
+            record.msg = f"{record.getMessage()} ({dropped} similar messages suppressed)"
+            record.args = ()
+        return True
+
+def configure_logging(level='info', rate=LOG_RATE):
+    """
+    Sends the server log to stdout at `level` (debug, info, warning or error). Per-chunk lines
+    are only logged at debug level, so the default level keeps logging off the transfer path.
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter(rate))
+    logger.handlers[:] = [handler]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
 # --- Helper Function to ensure directory exists ---
 def ensure_dir(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
-        print(f"Created directory: {directory}")
+        logger.info(f"Created directory: {directory}")
 
-# --- File Transfer Handler for a single client/file ---
-def handle_file_transfer(data_socket, client_address, filename, file_size):
+# --- Helper Function to parse trailing 'KEY VALUE' options of a message ---
+def parse_options(tokens):
     """
-    Handles the reliable transfer of a single file to a specific client.
-    This runs in a new thread for each file download.
+    Turns ['WINDOW', '32', ...] into {'WINDOW': '32', ...}.
+    Returns None if the tokens do not form complete KEY VALUE pairs.
     """
-    print(f"[Thread {threading.get_ident()}] Handling transfer of '{filename}' to {client_address} via port {data_socket.getsockname()[1]}")
+    if len(tokens) % 2 != 0:
+        return None
+    return {tokens[i].upper(): tokens[i + 1] for i in range(0, len(tokens), 2)}
 
-    file_path = os.path.join(FILES_DIR, filename)
-    current_offset = 0 # Keep track of the current byte offset in the file
+# --- Helper Function to negotiate the transfer options of a DOWNLOAD ---
+def negotiate_options(requested, filename=None):
+    """
+    Decides which of the client's proposed options this server accepts.
+    Returns the accepted options as a dict; only these are echoed in the OK reply,
+    so a client that proposed nothing gets the plain legacy reply.
+    The whole-file DIGEST is only looked up when a filename is given.
+    """
+    accepted = {}
+    if 'WINDOW' in requested:
+        try:
+            window = int(requested['WINDOW'])
+        except ValueError:
+            window = 0
+        if window > 1:
+            accepted['WINDOW'] = min(window, MAX_WINDOW)
+    if requested.get('FORMAT', '').upper() == 'BINARY':
+        accepted['FORMAT'] = 'BINARY'
+        # Binary packets carry this id instead of the filename
+        accepted['SESSION'] = random.getrandbits(32)
+    if 'CHUNK' in requested:
+        try:
+            chunk_size = int(requested['CHUNK'])
+        except ValueError:
+            chunk_size = 0
+        if chunk_size > 0:
+            # Clamp to what one datagram carries in the negotiated format
+            largest = MAX_CHUNK_SIZE if accepted.get('FORMAT') == 'BINARY' else MAX_TEXT_CHUNK_SIZE
+            accepted['CHUNK'] = max(MIN_CHUNK_SIZE, min(chunk_size, largest))
+    if 'FEC' in requested and 'WINDOW' in accepted and accepted.get('FORMAT') == 'BINARY':
+        # XOR parity over groups of chunks; needs chunk requests by session id and any order
+        try:
+            group = int(requested['FEC'])
+            parity = int(requested.get('FEC_PARITY', 1))
+        except ValueError:
+            group = 0
+        if group > 1:
+            accepted['FEC'] = min(group, MAX_FEC_GROUP)
+            accepted['FEC_PARITY'] = max(1, min(parity, MAX_FEC_PARITY, accepted['FEC'] // 2))
+    if requested.get('DELTA', '').upper() == BLOCK_HASH_ALGORITHM and 'WINDOW' in accepted and accepted.get('FORMAT') == 'BINARY':
+        # Block hashes of every chunk, so the client can fetch only the chunks its copy lacks
+        accepted['DELTA'] = BLOCK_HASH_ALGORITHM
+    if requested.get('CHECKSUM', '').upper() == 'CRC32':
+        # Per-chunk CRC32 in every DATA packet, plus the whole-file digest once it is known
+        accepted['CHECKSUM'] = 'CRC32'
+        digest = file_cache.digest(filename) if filename is not None else None
+        if digest is not None:
+            accepted['DIGEST'] = f"sha256:{digest}"
+    return accepted
 
-    try:
-        with open(file_path, 'rb') as f:
-            while current_offset < file_size:
-                # 1. Receive client's request for the next chunk
+# --- Helper Function to parse a chunk request ---
+def parse_chunk_request(request_data, filename, session_id):
+    """
+    Accepts either "REQ <filename> START <start_byte> END <end_byte>" or, when the binary
+    format was negotiated (session_id is not None), a PKT_REQ header for this session.
+    Returns (start_byte, end_byte), or None if the packet is not a chunk request.
+    Raises ValueError if a text request carries unparsable offsets.
+    """
+    if session_id is not None and request_data[0] == PACKET_MAGIC:
+        if len(request_data) < PACKET_HEADER.size:
+            return None
+        _, packet_type, _, packet_session, offset, length, _ = PACKET_HEADER.unpack_from(request_data)
+        if packet_type != PKT_REQ or packet_session != session_id or length == 0:
+            return None
+        return offset, offset + length - 1
+
+    parts = str(request_data, 'utf-8', errors='replace').strip().split()
+    if len(parts) == 6 and parts[0] == "REQ" and parts[1] == filename and parts[2] == "START" and parts[4] == "END":
+        return int(parts[3]), int(parts[5])
+    return None
+
+# --- Helper Function to build a DATA packet in the negotiated format ---
+def build_data_packet(filename, session_id, start_byte, end_byte, chunk, file_size, with_crc=False, header=None):
+    """
+    Returns the DATA packet as a (header, payload) tuple of buffers for send_packet(), so the
+    chunk is never copied into a packet-sized bytes object. A binary header is packed into
+    `header` (a reusable bytearray) if one is given.
+    """
+    crc = zlib.crc32(chunk) if with_crc else 0
+    if session_id is not None:
+        flags = FLAG_LAST_CHUNK if start_byte + len(chunk) >= file_size else 0
+        if with_crc:
+            flags |= FLAG_CRC
+        header = header if header is not None else bytearray(PACKET_HEADER.size)
+        PACKET_HEADER.pack_into(header, 0, PACKET_MAGIC, PKT_DATA, flags, session_id, start_byte, len(chunk), crc)
+        return header, chunk
+    # The CRC (if negotiated) goes before the base64 encoded data
+    crc_field = f"CRC {crc} " if with_crc else ""
+    return f"DATA {filename} START {start_byte} END {end_byte} {crc_field}".encode('utf-8'), base64.b64encode(chunk)
+
+# --- Helpers for sending and receiving datagrams without per-packet copies ---
+def send_packet(sock, packet, address):
+    """
+    Sends one datagram. DATA packets come as a tuple of buffers, which sendmsg() gathers in the
+    kernel; everything else is a plain bytes object.
+    """
+    if not isinstance(packet, tuple):
+        return sock.sendto(packet, address)
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(packet, (), 0, address)
+    return sock.sendto(b''.join(packet), address)
+
+def receive_packet(sock, buffer):
+    """
+    Receives one datagram into the caller's reusable bytearray. Returns (packet, address):
+    binary packets as a memoryview of the buffer, valid until the next call, text messages as bytes.
+    """
+    nbytes, address = sock.recvfrom_into(buffer)
+    packet = memoryview(buffer)[:nbytes]
+    if nbytes == 0 or packet[0] != PACKET_MAGIC:
+        packet = packet.tobytes()
+    return packet, address
+
+# --- Shared cache of file metadata and memory-mapped file contents ---
+class FileCache:
+    """
+    Serves chunk reads for hot files from memory-mapped views instead of seek()+read() per REQ,
+    and caches stat() results so popular DOWNLOADs do not hit the filesystem every time.
+
+    Mapped files are kept in LRU order within `byte_budget` bytes; files larger than the budget
+    are never mapped and callers fall back to reading them directly. A mapping is dropped when a
+    fresh stat() shows the file's size or mtime changed, and when an fstat() of the mapped file,
+    done before every read, shows it was cut or grown in place: touching a mapped page past the
+    end of the file raises SIGBUS. A file truncated between that check and the send can still
+    fault, so files being served should be replaced by renaming a new copy over them. Evicted
+    mappings are not closed explicitly: chunk views handed out earlier keep them alive until
+    they are released.
+    Thread-safe, so all threads of the threaded engine share one instance.
+    """
+
+    def __init__(self, directory, byte_budget, stat_ttl=CACHE_STAT_TTL, hash_directory=BLOCK_HASH_DIR,
+                 sync_limit=DIGEST_SYNC_LIMIT):
+        self.directory = directory
+        self.hash_directory = hash_directory
+        self.byte_budget = byte_budget
+        self.stat_ttl = stat_ttl
+        self.sync_limit = sync_limit # Larger files are hashed by a background thread
+        self.lock = threading.Lock()
+        self.metadata = OrderedDict() # filename -> (checked_at, (size, mtime_ns) or None), LRU first
+        self.digests = {}           # filename -> ((size, mtime_ns), SHA-256 hex digest)
+        self.hashing = set()        # Files being hashed by a background thread
+        self.block_hashes_cache = OrderedDict() # (filename, block size) -> ((size, mtime_ns), block hashes), LRU first
+        self.hashing_blocks = set() # (filename, block size) being hashed block by block
+        self.mapped = OrderedDict() # filename -> ((size, mtime_ns), memoryview of the mapping, mmap), LRU first
+        self.mapped_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stat(self, filename):
+        """Returns the file size, or None if `filename` is not a regular file in the directory."""
+        with self.lock:
+            version = self._version(filename)
+        return version[0] if version is not None else None
+
+    def read(self, filename, offset, length):
+        """
+        Returns a zero-copy memoryview of `length` bytes at `offset`, or None if the file
+        cannot be served from the cache (missing, empty or larger than the budget).
+        """
+        with self.lock:
+            version = self._version(filename)
+            if version is None:
+                return None
+            entry = self.mapped.get(filename)
+            if entry is not None and entry[2].size() != len(entry[1]):
+                # Changed in place since it was mapped; stat() it again rather than wait for the TTL
+                self._drop(filename)
+                self.invalidations += 1
+                del self.metadata[filename]
+                version = self._version(filename)
+                if version is None:
+                    return None
+                entry = None
+            if entry is not None:
+                self.hits += 1
+                self.mapped.move_to_end(filename)
+            else:
+                self.misses += 1
+                entry = self._map(filename, version)
+                if entry is None:
+                    return None
+        return entry[1][offset:offset + length]
+
+    def digest(self, filename):
+        """
+        Returns the SHA-256 hex digest of the file, or None if it is not known (yet).
+        Computed once per file version (size and mtime) and then served from memory. Files up to
+        `sync_limit` bytes are hashed right away; larger ones are hashed by a background
+        thread so the DOWNLOAD that asked first is not held up, and later DOWNLOADs get the digest.
+        """
+        with self.lock:
+            version = self._version(filename)
+            if version is None:
+                return None
+            cached = self.digests.get(filename)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+            if version[0] > self.sync_limit:
+                if filename not in self.hashing:
+                    self.hashing.add(filename)
+                    threading.Thread(target=self._hash, args=(filename, version), daemon=True).start()
+                return None
+        return self._hash(filename, version)
+
+    def block_hashes(self, filename, block_size):
+        """
+        Returns the BLOCK_HASH_SIZE-byte BLAKE2b hashes of the file's consecutive `block_size`-byte
+        blocks, concatenated, or None if they are not known (yet). As with digest(), larger files
+        are hashed by a background thread. Every hash list is also stored in `hash_directory`,
+        so unchanged files are not hashed again after a restart.
+        """
+        key = (filename, block_size)
+        with self.lock:
+            version = self._version(filename)
+            if version is None:
+                return None
+            cached = self.block_hashes_cache.get(key)
+            if cached is not None and cached[0] == version:
+                self.block_hashes_cache.move_to_end(key)
+                return cached[1]
+            if key in self.hashing_blocks:
+                return None
+            self.hashing_blocks.add(key)
+            if version[0] > self.sync_limit:
+                threading.Thread(target=self._hash_blocks, args=(filename, block_size, version), daemon=True).start()
+                return None
+        return self._hash_blocks(filename, block_size, version)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'mapped_files': len(self.mapped),
+                'mapped_bytes': self.mapped_bytes,
+                'budget_bytes': self.byte_budget,
+            }
+
+    def _version(self, filename):
+        # Caller holds self.lock
+        now = time.monotonic()
+        cached = self.metadata.get(filename)
+        if cached is not None and now - cached[0] < self.stat_ttl:
+            self.metadata.move_to_end(filename)
+            return cached[1]
+        try:
+            st = os.stat(os.path.join(self.directory, filename))
+            version = (st.st_size, st.st_mtime_ns) if stat.S_ISREG(st.st_mode) else None
+        except OSError:
+            version = None
+        self.metadata[filename] = (now, version)
+        self.metadata.move_to_end(filename)
+        while len(self.metadata) > CACHE_STAT_ENTRIES:
+            self.metadata.popitem(last=False)
+        entry = self.mapped.get(filename)
+        if entry is not None and entry[0] != version:
+            self._drop(filename)
+            self.invalidations += 1
+        return version
+
+    def _map(self, filename, version):
+        # Caller holds self.lock
+        size = version[0]
+        if size == 0 or size > self.byte_budget:
+            return None
+        while self.mapped and self.mapped_bytes + size > self.byte_budget:
+            self._drop(next(iter(self.mapped)))
+            self.evictions += 1
+        try:
+            with open(os.path.join(self.directory, filename), 'rb') as f:
+                mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        entry = (version, memoryview(mapping), mapping)
+        self.mapped[filename] = entry
+        self.mapped_bytes += size
+        return entry
+
+    def _hash(self, filename, version):
+        # Hash without holding the lock; other threads keep serving chunks meanwhile
+        sha256 = hashlib.sha256()
+        try:
+            with open(os.path.join(self.directory, filename), 'rb') as f:
+                for block in iter(lambda: f.read(DIGEST_BLOCK_SIZE), b''):
+                    sha256.update(block)
+        except OSError:
+            sha256 = None
+        with self.lock:
+            self.hashing.discard(filename)
+            if sha256 is None:
+                return None
+            self.digests[filename] = (version, sha256.hexdigest())
+        return sha256.hexdigest()
+
+    def _hash_blocks(self, filename, block_size, version):
+        # Without holding the lock, like _hash(); the stored list is used if it is for this version
+        key = (filename, block_size)
+        # Named after a hash of the filename, so no name can place the file outside hash_directory
+        name_hash = hashlib.sha256(filename.encode('utf-8', errors='surrogateescape')).hexdigest()[:32]
+        cache_path = os.path.join(self.hash_directory, f"{name_hash}.{block_size}.b2")
+        expected_length = math.ceil(version[0] / block_size) * BLOCK_HASH_SIZE
+        hashes = None
+        try:
+            with open(cache_path, 'rb') as cache_file:
+                stored = cache_file.read()
+            if stored[:BLOCK_HASH_HEADER.size] == BLOCK_HASH_HEADER.pack(*version) \
+               and len(stored) == BLOCK_HASH_HEADER.size + expected_length:
+                hashes = stored[BLOCK_HASH_HEADER.size:]
+        except OSError:
+            pass
+        if hashes is None:
+            try:
+                with open(os.path.join(self.directory, filename), 'rb') as f:
+                    hashes = b''.join(hashlib.blake2b(block, digest_size=BLOCK_HASH_SIZE).digest()
+                                      for block in iter(lambda: f.read(block_size), b''))
+            except OSError:
+                hashes = None
+            if hashes is not None and len(hashes) == expected_length:
                 try:
-                    # Expecting "REQ <filename> START <start_byte> END <end_byte>"
-                    request_data, _ = data_socket.recvfrom(2048) # Sufficient buffer for request
-                    request_msg = request_data.decode('utf-8').strip()
-                    parts = request_msg.split()
-
-                    if len(parts) == 6 and parts[0] == "REQ" and parts[1] == filename and parts[2] == "START" and parts[4] == "END":
-                        req_start_byte = int(parts[3])
-                        req_end_byte = int(parts[5])
-                        
-                        # Basic validation: requested chunk must match what we expect to send next
-                        if req_start_byte != current_offset:
-                            print(f"[Thread {threading.get_ident()}] Warning: Client requested offset {req_start_byte}, but expected {current_offset}. Retransmitting previous chunk if needed.")
-                            # For simple stop-and-wait, we might just re-send the expected chunk.
-                            # In a more complex ARQ, we'd need sequence numbers to handle out-of-order/duplicates.
-                            # For now, we'll try to serve the requested chunk.
-
-                        # Read the chunk from the file
-                        f.seek(req_start_byte)
-                        chunk = f.read(req_end_byte - req_start_byte + 1)
-                        
-                        # Base64 encode the chunk
-                        encoded_chunk = base64.b64encode(chunk).decode('utf-8')
-                        
-                        # Construct the response packet
-                        response_msg = f"DATA {filename} START {req_start_byte} END {req_end_byte} {encoded_chunk}"
-                        
-                        data_socket.sendto(response_msg.encode('utf-8'), client_address)
-                        print(f"[Thread {threading.get_ident()}] Sent chunk {req_start_byte}-{req_end_byte} for '{filename}'.")
-                        
-                        # Only advance offset if we sent the expected chunk
-                        if req_start_byte == current_offset:
-                           current_offset += len(chunk)
-                    else:
-                        print(f"[Thread {threading.get_ident()}] Received invalid request: {request_msg}")
-                        # Optionally send an error back, or just ignore
-                        
-                except socket.timeout:
-                    print(f"[Thread {threading.get_ident()}] Socket timeout waiting for client's REQ. Client might have disconnected or timed out.")
-                    break # Exit loop if client stops responding
-                except ValueError as e:
-                    print(f"[Thread {threading.get_ident()}] Error parsing client request: {e}. Request was: {request_msg}")
-                    break
-                except Exception as e:
-                    print(f"[Thread {threading.get_ident()}] An unexpected error occurred during chunk transfer: {e}")
-                    break
-
-            # After sending all chunks, send FILE CLOSE confirmation
-            if current_offset >= file_size:
-                close_msg = f"FILE {filename} CLOSE_OK"
-                data_socket.sendto(close_msg.encode('utf-8'), client_address)
-                print(f"[Thread {threading.get_ident()}] Finished sending all chunks for '{filename}'. Sent CLOSE_OK.")
+                    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                    # Unique per process, so workers hashing the same file do not clash
+                    temporary_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                    with open(temporary_path, 'wb') as cache_file:
+                        cache_file.write(BLOCK_HASH_HEADER.pack(*version))
+                        cache_file.write(hashes)
+                    os.replace(temporary_path, cache_path)
+                except OSError as e:
+                    logger.warning(f"Could not store block hashes of '{filename}': {e}")
+        with self.lock:
+            self.hashing_blocks.discard(key)
+            # A file that changed while it was read is hashed again on the next request
+            if hashes is None or len(hashes) != expected_length:
+                return None
+            self.block_hashes_cache[key] = (version, hashes)
+            while len(self.block_hashes_cache) > BLOCK_HASH_CACHE_FILES:
+                self.block_hashes_cache.popitem(last=False)
+        return hashes
+
+    def _drop(self, filename):
+        version, _view, _mapping = self.mapped.pop(filename)
+        self.mapped_bytes -= version[0]
+
+# The cache every session reads through; the budget can be changed from the command line
+file_cache = FileCache(FILES_DIR, CACHE_BUDGET_MB * 1024 * 1024)
+
+# --- Transfer metrics, reported by the STATS command ---
+class Histogram:
+    """Counts values into buckets with the given upper bounds, plus one bucket for larger values."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def snapshot(self):
+        buckets = {f"<={bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return buckets
+
+class SessionMetrics:
+    """
+    Counters of one transfer session. Only the thread serving the session updates them, so the
+    per-chunk path takes no lock; STATS may read a slightly stale snapshot.
+
+    A chunk request that starts below the highest offset already served is counted as a
+    retransmit. The time from the session start (the OK reply) to the first chunk request is
+    recorded as first_request_ms. It is not a round-trip time: it also covers whatever the client
+    does before asking, such as preallocating the file or comparing blocks for delta sync.
+    """
+
+    def __init__(self, label, filename, file_size):
+        self.label = label
+        self.filename = filename
+        self.file_size = file_size
+        self.started_at = time.time()
+        self.started = time.monotonic()
+        self.ended = None
+        self.state = 'active'
+        self.bytes_sent = 0
+        self.chunks_sent = 0
+        self.retransmits = 0
+        self.parity_sent = 0
+        self.high_water = 0    # End of the highest chunk served so far
+        self.first_request_ms = None
+
+    def record_chunk(self, offset, length):
+        if self.chunks_sent == 0:
+            self.first_request_ms = (time.monotonic() - self.started) * 1000
+            metrics_registry.record_first_request(self.first_request_ms)
+        if offset < self.high_water:
+            self.retransmits += 1
+        else:
+            self.high_water = offset + length
+        self.chunks_sent += 1
+        self.bytes_sent += length
+
+    def snapshot(self):
+        elapsed = max((self.ended or time.monotonic()) - self.started, 1e-9)
+        return {
+            'session': self.label,
+            'file': self.filename,
+            'size': self.file_size,
+            'state': self.state,
+            'started': round(self.started_at, 3),
+            'duration_s': round(elapsed, 3),
+            'bytes_sent': self.bytes_sent,
+            'chunks_sent': self.chunks_sent,
+            'retransmits': self.retransmits,
+            'parity_sent': self.parity_sent,
+            'first_request_ms': round(self.first_request_ms, 2) if self.first_request_ms is not None else None,
+            'throughput_bps': round(self.bytes_sent / elapsed),
+        }
+
+class MetricsRegistry:
+    """
+    Keeps the metrics of every active session and of the last `keep_finished` finished ones,
+    plus totals since the server started. Thread-safe, so all threads share one instance.
+    """
+
+    def __init__(self, keep_finished=MAX_FINISHED_SESSIONS):
+        self.lock = threading.Lock()
+        self.active = {}            # id(SessionMetrics) -> SessionMetrics, oldest first
+        self.finished = deque(maxlen=keep_finished)
+        self.first_request_histogram = Histogram(FIRST_REQUEST_BOUNDS_MS)
+        self.sessions_started = 0
+        self.sessions_completed = 0
+        self.sessions_incomplete = 0
+        self.finished_bytes = 0     # Totals of finished sessions; active ones are added in snapshot()
+        self.finished_chunks = 0
+        self.finished_retransmits = 0
+        self.finished_parity = 0
+
+    def open(self, label, filename, file_size):
+        session_metrics = SessionMetrics(label, filename, file_size)
+        with self.lock:
+            self.active[id(session_metrics)] = session_metrics
+            self.sessions_started += 1
+        return session_metrics
+
+    def record_first_request(self, delay_ms):
+        with self.lock:
+            self.first_request_histogram.add(delay_ms)
+
+    def close(self, session_metrics, completed):
+        with self.lock:
+            if self.active.pop(id(session_metrics), None) is None:
+                return # Already closed
+            session_metrics.ended = time.monotonic()
+            session_metrics.state = 'completed' if completed else 'incomplete'
+            if completed:
+                self.sessions_completed += 1
             else:
-                print(f"[Thread {threading.get_ident()}] Transfer of '{filename}' did not complete. Sent {current_offset}/{file_size} bytes.")
+                self.sessions_incomplete += 1
+            self.finished_bytes += session_metrics.bytes_sent
+            self.finished_chunks += session_metrics.chunks_sent
+            self.finished_retransmits += session_metrics.retransmits
+            self.finished_parity += session_metrics.parity_sent
+            self.finished.append(session_metrics)
+
+    def snapshot(self, max_sessions=STATS_MAX_SESSIONS):
+        """Totals plus the active sessions and then the most recently finished ones, at most `max_sessions`."""
+        with self.lock:
+            active = list(self.active.values())
+            recent = list(self.finished)[::-1]
+            totals = {
+                'sessions_started': self.sessions_started,
+                'sessions_active': len(active),
+                'sessions_completed': self.sessions_completed,
+                'sessions_incomplete': self.sessions_incomplete,
+                'bytes_sent': self.finished_bytes + sum(m.bytes_sent for m in active),
+                'chunks_sent': self.finished_chunks + sum(m.chunks_sent for m in active),
+                'retransmits': self.finished_retransmits + sum(m.retransmits for m in active),
+                'parity_sent': self.finished_parity + sum(m.parity_sent for m in active),
+            }
+            first_request_histogram = self.first_request_histogram.snapshot()
+        return {
+            'totals': totals,
+            'first_request_ms': first_request_histogram,
+            'sessions': [m.snapshot() for m in (active + recent)[:max_sessions]],
+        }
+
+# The registry every session reports to
+metrics_registry = MetricsRegistry()
+
+# --- Protocol state of a single client/file transfer ---
+class TransferSession:
+    """
+    Serves the chunk requests of one file download, independent of how packets reach it.
+    Both server engines feed it the raw packets a client sends for this transfer and
+    send back the packets it returns.
+
+    In legacy (stop-and-wait) mode the transfer ends once every byte has been served in order.
+    In windowed mode the client keeps several REQs in flight and may re-request any chunk
+    out of order, so the session stays open until the client sends FILE <filename> CLOSE.
+    """
+
+    def __init__(self, filename, file_size, options, label):
+        self.filename = filename
+        self.file_size = file_size
+        self.options = options
+        self.windowed = 'WINDOW' in options
+        self.session_id = options.get('SESSION') # Set only when the binary format was negotiated
+        self.with_crc = options.get('CHECKSUM') == 'CRC32'
+        self.chunk_size = options.get('CHUNK', CHUNK_SIZE) # Longest chunk a request may ask for
+        self.label = label                       # Prefix for log lines, e.g. "[Thread 1234]"
+        self.current_offset = 0                  # Keep track of the current byte offset in the file
+        self.closed_by_client = False
+        self.client_address = None               # Client data address, learned by the eventloop engine
+        self.finished = False
+        # Raises FileNotFoundError if the file vanished since the DOWNLOAD handshake
+        if file_cache.stat(filename) is None:
+            raise FileNotFoundError(filename)
+        self.file = None                         # Opened only for files the cache does not map
+        self.read_buffer = None                  # Reused for every chunk read from self.file
+        self.header = bytearray(PACKET_HEADER.size) # Reused for every binary DATA header
+        self.fec_group = options.get('FEC')      # Chunks per FEC group, None without FEC
+        self.fec_parity = options.get('FEC_PARITY', 1)
+        self.fec_next_group = 0                  # Parity goes out once per group, not again on retransmits
+        self.delta = 'DELTA' in options          # Serve block hashes (PKT_HASH_REQ) for delta sync
+        self.last_activity = time.monotonic()    # When the client last sent a packet, for idle reaping
+        self.metrics = metrics_registry.open(label, filename, file_size)
+
+    def handle_packet(self, request_data):
+        """
+        Processes one packet from the client and returns the list of packets to send back.
+        Raises ValueError if a text request carries unparsable offsets.
+        """
+        if not request_data:
+            return []
+        self.last_activity = time.monotonic()
+        chunk_request = parse_chunk_request(request_data, self.filename, self.session_id)
+
+        if chunk_request is not None:
+            req_start_byte, req_end_byte = chunk_request
+
+            if req_start_byte < 0 or req_end_byte < req_start_byte or req_end_byte >= self.file_size \
+               or req_end_byte - req_start_byte + 1 > self.chunk_size:
+                logger.warning(f"{self.label} Ignoring out-of-range request {req_start_byte}-{req_end_byte} for '{self.filename}'.")
+                return []
+
+            # Basic validation: requested chunk must match what we expect to send next
+            if not self.windowed and req_start_byte != self.current_offset:
+                logger.debug(f"{self.label} Client requested offset {req_start_byte}, but expected {self.current_offset}. Retransmitting previous chunk if needed.")
+                # For simple stop-and-wait, we might just re-send the expected chunk.
+                # In a more complex ARQ, we'd need sequence numbers to handle out-of-order/duplicates.
+                # For now, we'll try to serve the requested chunk.
+
+            # Read the chunk: a slice of the cached mapping, or from the file itself
+            chunk_length = req_end_byte - req_start_byte + 1
+            chunk = file_cache.read(self.filename, req_start_byte, chunk_length)
+            if chunk is None:
+                chunk = self.read_chunk(req_start_byte, chunk_length)
+
+            responses = [build_data_packet(self.filename, self.session_id, req_start_byte, req_end_byte, chunk, self.file_size,
+                                           self.with_crc, self.header)]
+            self.metrics.record_chunk(req_start_byte, len(chunk))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"{self.label} Sent chunk {req_start_byte}-{req_end_byte} for '{self.filename}'.")
+            if self.fec_group is not None and req_start_byte % self.chunk_size == 0:
+                index = req_start_byte // self.chunk_size
+                group = index // self.fec_group
+                # Right behind the last chunk of a group, so the client can repair a loss before its RTO
+                if group >= self.fec_next_group and (index % self.fec_group == self.fec_group - 1 or req_end_byte == self.file_size - 1):
+                    self.fec_next_group = group + 1
+                    responses.extend(self.parity_packets(group))
+
+            # Only advance offset if we sent the expected chunk
+            if req_start_byte == self.current_offset:
+                self.current_offset += len(chunk)
+            # A stop-and-wait transfer is over once the last chunk went out in order
+            if not self.windowed and self.current_offset >= self.file_size:
+                responses.append(self.finish())
+            return responses
+
+        if self.delta and request_data[0] == PACKET_MAGIC:
+            return self.hash_packets(request_data)
+
+        request_msg = str(request_data, 'utf-8', errors='replace').strip()
+        parts = request_msg.split()
+        if len(parts) == 3 and parts[0] == "FILE" and parts[1] == self.filename and parts[2] == "CLOSE":
+            # The windowed client has every chunk; it is the one that decides when we are done
+            self.closed_by_client = True
+            return [self.finish()]
+
+        logger.warning(f"{self.label} Received invalid request: {request_msg[:80]}")
+        # Optionally send an error back, or just ignore
+        return []
+
+    def read_chunk(self, offset, length):
+        """
+        Reads a chunk from the file itself into the session's reusable buffer (with a single
+        preadv() where available) and returns a memoryview of the bytes read. The view is only
+        valid until the next call, by which time its DATA packet has been sent.
+        """
+        if self.file is None:
+            self.file = open(os.path.join(FILES_DIR, self.filename), 'rb', buffering=0)
+            self.read_buffer = memoryview(bytearray(self.chunk_size))
+        view = self.read_buffer[:length]
+        if hasattr(os, 'preadv'):
+            count = os.preadv(self.file.fileno(), [view], offset)
+        else:
+            self.file.seek(offset)
+            count = self.file.readinto(view)
+        return view[:count]
+
+    def parity_packets(self, group):
+        """
+        Builds the FEC_PARITY parity packets of a group of FEC chunks. Parity packet j is the XOR of
+        the group's chunks j, j + FEC_PARITY, j + 2 * FEC_PARITY, ... (the shorter last chunk
+        zero-padded), so each one repairs a single lost chunk of its subset, and together they repair
+        a burst of up to FEC_PARITY consecutive losses. Its header carries the offset of the subset's
+        first chunk. The chunks are re-read rather than kept, since every one of them went out earlier.
+        """
+        chunk_count = math.ceil(self.file_size / self.chunk_size)
+        first = group * self.fec_group
+        last = min(first + self.fec_group, chunk_count)
+        packets = []
+        for subset_start in range(first, min(first + self.fec_parity, last)):
+            parity = 0
+            parity_length = 0
+            for index in range(subset_start, last, self.fec_parity):
+                chunk = self.read_bytes(index * self.chunk_size, self.chunk_size)
+                parity ^= int.from_bytes(chunk, 'little')
+                parity_length = max(parity_length, len(chunk))
+            payload = parity.to_bytes(parity_length, 'little')
+            crc = zlib.crc32(payload) if self.with_crc else 0
+            header = PACKET_HEADER.pack(PACKET_MAGIC, PKT_PARITY, FLAG_CRC if self.with_crc else 0, self.session_id,
+                                        subset_start * self.chunk_size, parity_length, crc)
+            packets.append((header, payload))
+        self.metrics.parity_sent += len(packets)
+        return packets
+
+    def hash_packets(self, request_data):
+        """
+        Answers a PKT_HASH_REQ with one PKT_HASHES packet holding the block hashes of the chunks
+        covering `length` bytes at `offset`, at most HASHES_PER_PACKET of them (the client asks
+        again for the rest). While the file is still being hashed the packet has no hashes at all.
+        """
+        if len(request_data) < PACKET_HEADER.size:
+            return []
+        _, packet_type, _, packet_session, offset, length, _ = PACKET_HEADER.unpack_from(request_data)
+        if packet_type != PKT_HASH_REQ or packet_session != self.session_id or offset % self.chunk_size != 0 \
+           or offset >= self.file_size or length == 0:
+            logger.warning(f"{self.label} Ignoring invalid binary request (type {packet_type}, offset {offset}).")
+            return []
+        hashes = file_cache.block_hashes(self.filename, self.chunk_size)
+        if hashes is None:
+            hashes = b''
+        else:
+            first = offset // self.chunk_size
+            count = min(math.ceil(length / self.chunk_size), HASHES_PER_PACKET)
+            hashes = memoryview(hashes)[first * BLOCK_HASH_SIZE:(first + count) * BLOCK_HASH_SIZE]
+        crc = zlib.crc32(hashes) if self.with_crc else 0
+        header = PACKET_HEADER.pack(PACKET_MAGIC, PKT_HASHES, FLAG_CRC if self.with_crc else 0, self.session_id,
+                                    offset, len(hashes), crc)
+        return [(header, hashes)]
+
+    def read_bytes(self, offset, length):
+        """Reads up to `length` bytes at `offset` into a new buffer, leaving the reusable chunk buffer alone."""
+        chunk = file_cache.read(self.filename, offset, length)
+        if chunk is not None:
+            return chunk
+        if self.file is None:
+            self.file = open(os.path.join(FILES_DIR, self.filename), 'rb', buffering=0)
+            self.read_buffer = memoryview(bytearray(self.chunk_size))
+        return os.pread(self.file.fileno(), length, offset)
+
+    def initial_packets(self):
+        """
+        Packets to send as soon as the session starts. A stop-and-wait client never requests
+        a chunk of an empty file, so that transfer is confirmed right away.
+        """
+        if not self.windowed and self.file_size == 0:
+            return [self.finish()]
+        return []
+
+    def finish(self):
+        """Marks the transfer as complete and returns the FILE CLOSE confirmation."""
+        self.finished = True
+        logger.info(f"{self.label} Finished sending all chunks for '{self.filename}'. Sent CLOSE_OK.")
+        return f"FILE {self.filename} CLOSE_OK".encode('utf-8')
+
+    def close(self):
+        if not self.finished:
+            logger.warning(f"{self.label} Transfer of '{self.filename}' did not complete. Sent {self.current_offset}/{self.file_size} bytes.")
+        metrics_registry.close(self.metrics, self.finished)
+        if self.file is not None:
+            self.file.close()
+
+# --- Helper Function to validate a DOWNLOAD request ---
+def lookup_download(message):
+    """
+    Parses "DOWNLOAD <filename> [KEY VALUE]..." and looks the file up in FILES_DIR.
+    Returns (filename, file_size, requested_options); file_size is None if the file does not exist.
+    Returns None if the message is not a well-formed DOWNLOAD.
+    """
+    parts = message.split()
+    requested_options = parse_options(parts[2:]) if len(parts) >= 2 else None
+    if len(parts) < 2 or parts[0] != "DOWNLOAD" or requested_options is None:
+        return None
+    filename = parts[1]
+    return filename, file_cache.stat(filename), requested_options
+
+# --- Helper Function to build the OK reply, echoing only the options we accepted ---
+def build_ok_response(filename, file_size, data_port, options):
+    ok_response = f"OK {filename} SIZE {file_size} PORT {data_port}"
+    ok_response += ''.join(f" {key} {value}" for key, value in options.items())
+    return ok_response.encode('utf-8')
+
+# --- Batch handshake: one DOWNLOAD_MANY for many files ---
+def lookup_download_many(message):
+    """
+    Parses "DOWNLOAD_MANY [KEY VALUE]... FILES <filename>...".
+    Returns (requested_options, filenames), or None if the message is not a well-formed DOWNLOAD_MANY.
+    """
+    parts = message.split()
+    if len(parts) < 3 or parts[0] != "DOWNLOAD_MANY" or "FILES" not in parts:
+        return None
+    marker = parts.index("FILES")
+    requested_options = parse_options(parts[1:marker])
+    filenames = parts[marker + 1:]
+    if requested_options is None or not filenames:
+        return None
+    return requested_options, filenames
+
+def open_download_many(filenames, requested_options, data_port, client_address):
+    """
+    Builds the reply to a DOWNLOAD_MANY and opens a session for every file it lists.
+    The reply is "OK_MANY PORT <port> [KEY VALUE]..." followed by one line per file:
+    "<filename> NOT_FOUND", or "<filename> <size> [DIGEST <digest>]" plus either "ID <session id>"
+    or, for files of at most INLINE_LIMIT bytes, "INLINE <base64>" (no session, no REQs at all;
+    an empty file has neither). Every session shares the data port and is told apart by its id.
+    Files that no longer fit into one datagram are left out; the client asks for them again.
+    Returns (reply, sessions); the reply is an ERR if the client did not propose the binary
+    windowed protocol, which the multiplexing relies on.
+    """
+    options = negotiate_options(requested_options)
+    if 'WINDOW' not in options or options.get('FORMAT') != 'BINARY':
+        return b"ERR DOWNLOAD_MANY UNSUPPORTED", []
+    del options['SESSION'] # Every file gets its own
+    reply_lines = [f"OK_MANY PORT {data_port}" + ''.join(f" {key} {value}" for key, value in options.items())]
+    reply_size = len(reply_lines[0])
+    sessions = []
+    for filename in filenames:
+        file_size = file_cache.stat(filename)
+        session_id = None
+        if file_size is None:
+            line = f"{filename} NOT_FOUND"
+        else:
+            line = f"{filename} {file_size}"
+            if options.get('CHECKSUM') == 'CRC32':
+                digest = file_cache.digest(filename)
+                if digest is not None:
+                    line += f" DIGEST sha256:{digest}"
+            if file_size > INLINE_LIMIT:
+                session_id = random.getrandbits(32)
+                line += f" ID {session_id}"
+            elif file_size > 0:
+                chunk = file_cache.read(filename, 0, file_size)
+                if chunk is None:
+                    try:
+                        with open(os.path.join(FILES_DIR, filename), 'rb') as f:
+                            chunk = f.read(file_size)
+                    except OSError:
+                        # Removed or replaced since the (cached) stat()
+                        chunk = None
+                if chunk is None:
+                    line = f"{filename} NOT_FOUND"
+                else:
+                    line += f" INLINE {base64.b64encode(chunk).decode('utf-8')}"
+        if reply_size + 1 + len(line) > MAX_REPLY_SIZE:
+            break
+        if session_id is not None:
+            try:
+                sessions.append(TransferSession(filename, file_size, dict(options, SESSION=session_id),
+                                                f"[Batch {filename}@{client_address[0]}]"))
+            except FileNotFoundError:
+                line = f"{filename} NOT_FOUND"
+        reply_lines.append(line)
+        reply_size += 1 + len(line)
+    logger.info(f"Answered DOWNLOAD_MANY for {len(reply_lines) - 1}/{len(filenames)} files "
+                f"({len(sessions)} sessions) from {client_address}")
+    return '\n'.join(reply_lines).encode('utf-8'), sessions
+
+def parse_close_many(message):
+    """Returns the session ids of "CLOSE_MANY <session id>...", or None if the message is not one."""
+    parts = message.split()
+    if len(parts) < 2 or parts[0] != "CLOSE_MANY":
+        return None
+    try:
+        return [int(token) for token in parts[1:]]
+    except ValueError:
+        return None
+
+# --- Packet counters used to compare the server engines ---
+class EngineCounters:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.packets_in = 0
+        self.packets_out = 0
+
+    def add(self, packets_in, packets_out):
+        with self.lock:
+            self.packets_in += packets_in
+            self.packets_out += packets_out
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        with self.lock:
+            packets_in, packets_out = self.packets_in, self.packets_out
+        return {
+            'uptime_s': round(elapsed, 1),
+            'packets_in': packets_in,
+            'packets_out': packets_out,
+            'packets_per_sec': round((packets_in + packets_out) / elapsed),
+            # ru_maxrss is reported in kilobytes on Linux
+            'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0,
+            'threads': threading.active_count(),
+        }
+
+    def report(self, engine):
+        snapshot = self.snapshot()
+        logger.info(f"[{engine} engine] {snapshot['packets_in']} packets in, {snapshot['packets_out']} packets out "
+                    f"in {snapshot['uptime_s']:.1f}s ({snapshot['packets_per_sec']} packets/sec), "
+                    f"peak RSS {snapshot['peak_rss_kb']} KB, {snapshot['threads']} threads.")
+        logger.info(f"[{engine} engine] File cache: {file_cache.stats()}")
+        logger.info(f"[{engine} engine] Sessions: {metrics_registry.snapshot(0)['totals']}")
+        logger.info(f"[{engine} engine] Admission: {admission.snapshot()}, pacing: {pacer.snapshot()}")
+
+# --- Admission control, idle sessions and send pacing ---
+class AdmissionControl:
+    """
+    Caps the transfer sessions open at once at `max_sessions` (0 for no cap). A DOWNLOAD that
+    finds no free slot is answered with "BUSY <filename> RETRY_AFTER <seconds>" and the client
+    asks again later, so an overload queues clients instead of exhausting ports, threads and
+    memory. Sessions whose client sent nothing for `idle_timeout` seconds are closed (reaped),
+    so a client that vanishes does not hold a slot forever. Thread-safe.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.lock = threading.Lock()
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.active = 0
+        self.rejected = 0
+        self.reaped = 0
+
+    def admit(self, count=1):
+        """Takes up to `count` free slots and returns how many it got (0: answer BUSY)."""
+        with self.lock:
+            granted = count if self.max_sessions <= 0 else max(min(count, self.max_sessions - self.active), 0)
+            self.active += granted
+            if granted == 0:
+                self.rejected += 1
+            return granted
+
+    def release(self, count=1):
+        with self.lock:
+            self.active -= count
+
+    def record_reaped(self, count=1):
+        with self.lock:
+            self.reaped += count
+
+    def snapshot(self):
+        with self.lock:
+            return {'active_sessions': self.active, 'max_sessions': self.max_sessions, 'rejected': self.rejected,
+                    'reaped': self.reaped, 'idle_timeout_s': self.idle_timeout}
+
+def build_busy_response(name):
+    return f"BUSY {name} RETRY_AFTER {BUSY_RETRY_AFTER:g}".encode('utf-8')
+
+class Pacer:
+    """
+    Token buckets limiting the bytes of DATA (and parity and hash) packets sent per second, in
+    total (`rate`) and to each client IP (`client_rate`), 0 for no limit. reserve() takes the
+    tokens a packet needs and returns how long to hold it back until they would have been there,
+    so packets leave at the allowed rate instead of overflowing socket buffers and links.
+    A full bucket always admits a packet, however low the rate. A packet queued behind more than
+    MAX_PACING_DELAY of earlier packets is dropped instead: the client sees a loss and shrinks its
+    congestion window. A client whose timer fires while its packet is held back asks for it again;
+    the copy it would get is dropped too, until the held one has been out for as long as it was
+    held, so duplicates do not eat into the rate. Thread-safe.
+    """
+
+    def __init__(self, rate=0, client_rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.client_rate = client_rate
+        self.total = [self._capacity(rate), time.monotonic()] # [tokens, last refill]
+        self.clients = {}   # client IP -> [tokens, last refill]
+        self.held = OrderedDict() # key of a held back packet -> time until which copies of it are dropped, oldest first
+        self.delayed = 0
+        self.dropped = 0
+        self.duplicates = 0
+
+    @property
+    def active(self):
+        return self.rate > 0 or self.client_rate > 0
+
+    def reserve(self, client_ip, nbytes, key=None):
+        """
+        Returns the seconds to hold back a packet of `nbytes` to `client_ip`, or None to drop it.
+        `key` identifies the packet's contents (and destination) to recognise copies of a held one.
+        """
+        now = time.monotonic()
+        with self.lock:
+            while self.held and next(iter(self.held.values())) <= now:
+                self.held.popitem(last=False)
+            if key is not None and self.held.get(key, now) > now:
+                self.duplicates += 1
+                return None
+            buckets = []
+            if self.rate > 0:
+                buckets.append((self.total, self.rate))
+            if self.client_rate > 0:
+                bucket = self.clients.get(client_ip)
+                if bucket is None:
+                    if len(self.clients) >= PACER_MAX_CLIENTS:
+                        self._prune(now)
+                    bucket = self.clients[client_ip] = [self._capacity(self.client_rate), now]
+                buckets.append((bucket, self.client_rate))
+            delay = 0.0
+            for bucket, rate in buckets:
+                bucket[0] = min(bucket[0] + (now - bucket[1]) * rate, self._capacity(rate))
+                bucket[1] = now
+                # Tokens go negative while packets are held back, so later packets queue behind them
+                if -bucket[0] / rate > MAX_PACING_DELAY:
+                    self.dropped += 1
+                    return None
+                delay = max(delay, (nbytes - bucket[0]) / rate)
+            for bucket, _rate in buckets:
+                bucket[0] -= nbytes
+            if delay > 0:
+                self.delayed += 1
+                if key is not None:
+                    self.held.pop(key, None)
+                    self.held[key] = now + 2 * delay
+            return delay
+
+    def snapshot(self):
+        with self.lock:
+            return {'rate_bps': self.rate, 'client_rate_bps': self.client_rate, 'delayed': self.delayed,
+                    'dropped': self.dropped, 'duplicates': self.duplicates, 'clients': len(self.clients)}
+
+    @staticmethod
+    def _capacity(rate):
+        return max(rate * PACING_BURST, PACING_MIN_BURST)
+
+    def _prune(self, now):
+        # Caller holds self.lock. A bucket that has refilled completely holds no state worth keeping.
+        capacity = self._capacity(self.client_rate)
+        for client_ip, bucket in list(self.clients.items()):
+            if bucket[0] + (now - bucket[1]) * self.client_rate >= capacity:
+                del self.clients[client_ip]
+
+def packet_size(packet):
+    """Bytes of a packet as returned by TransferSession.handle_packet (bytes or a tuple of buffers)."""
+    return sum(len(part) for part in packet) if isinstance(packet, tuple) else len(packet)
+
+class PacedSender:
+    """
+    Sends session packets through the pacer without sleeping: a packet it holds back waits in a
+    heap until it is due and goes out with the next flush(). The caller keeps reading requests
+    meanwhile, so a client asking again for a held packet reaches the pacer, which drops the copy,
+    instead of waiting in the socket behind a sleeping thread and then getting it sent twice.
+    One per thread (or event loop); not thread-safe.
+    """
+
+    def __init__(self):
+        self.held_back = []                # Heap of (send at, sequence, socket, packet, address)
+        self.sequence = itertools.count()  # Keeps packets due at the same time in order
+
+    def send(self, sock, packet, address):
+        """
+        Sends a session packet now, holds it back or drops it as the pacer says. Only DATA, parity
+        and hash packets (tuples) are paced; a control reply (bytes) is never dropped or delayed,
+        except to queue behind packets still held back for its client, so that a FILE CLOSE_OK
+        cannot overtake the last chunk. Returns True if it was sent now.
+        """
+        if not isinstance(packet, tuple):
+            held_until = max((held[0] for held in self.held_back if held[2] is sock and held[4] == address), default=None)
+            if held_until is not None:
+                heapq.heappush(self.held_back, (held_until, next(self.sequence), sock, packet, address))
+                return False
+        elif pacer.active:
+            delay = pacer.reserve(address[0], packet_size(packet), (address, bytes(packet[0])))
+            if delay is None:
+                return False
+            if delay > 0:
+                # The session reuses its buffers for its next packet, so hold back a copy
+                heapq.heappush(self.held_back, (time.monotonic() + delay, next(self.sequence), sock, b''.join(packet), address))
+                return False
+        try:
+            send_packet(sock, packet, address)
+            return True
+        except BlockingIOError:
+            # Socket send buffer is full; the client will time out and re-request
+            return False
+
+    def flush(self):
+        """Sends the held back packets that are due. Returns how many were sent."""
+        sent = 0
+        now = time.monotonic()
+        while self.held_back and self.held_back[0][0] <= now:
+            _, _, sock, packet, address = heapq.heappop(self.held_back)
+            try:
+                sock.sendto(packet, address)
+                sent += 1
+            except BlockingIOError:
+                pass
+        return sent
+
+    def drain(self):
+        """Waits for and sends every held back packet, for a thread about to close its socket. Returns how many were sent."""
+        sent = 0
+        while self.held_back:
+            time.sleep(max(self.held_back[0][0] - time.monotonic(), 0))
+            sent += self.flush()
+        return sent
+
+    def timeout(self, deadline):
+        """Seconds to wait for requests: until `deadline` (monotonic) or the next held back packet."""
+        if self.held_back:
+            deadline = min(deadline, self.held_back[0][0])
+        return max(deadline - time.monotonic(), PACING_TICK)
+
+# Shared by every session of this process; the limits can be changed from the command line
+admission = AdmissionControl()
+pacer = Pacer()
+
+# --- Reply to the STATS command ---
+def build_stats_response(engine, counters, max_sessions=STATS_MAX_SESSIONS):
+    """
+    Returns "STATS <json>" with the engine's packet counters, the file cache statistics and the
+    session metrics of this process. Sessions are left out until the reply fits one datagram.
+    """
+    while True:
+        stats = {'pid': os.getpid(), 'engine': engine, 'engine_counters': counters.snapshot(),
+                 'file_cache': file_cache.stats(), 'admission': admission.snapshot(), 'pacing': pacer.snapshot(),
+                 **metrics_registry.snapshot(max_sessions)}
+        reply = ("STATS " + json.dumps(stats, separators=(',', ':'))).encode('utf-8')
+        if len(reply) <= MAX_REPLY_SIZE or max_sessions == 0:
+            return reply
+        max_sessions //= 2
+
+# --- File Transfer Handler for a single client/file (threaded engine) ---
+def handle_file_transfer(data_socket, client_address, filename, file_size, options=None, counters=None):
+    """
+    Handles the reliable transfer of a single file to a specific client.
+    This runs in a new thread for each file download, which holds one admission slot until it
+    ends. The transfer is abandoned if the client sends nothing for the idle timeout.
+    """
+    options = options or {}
+    label = f"[Thread {threading.get_ident()}]"
+    logger.info(f"{label} Handling transfer of '{filename}' to {client_address} via port {data_socket.getsockname()[1]}"
+                f"{' (windowed, ' + str(options['WINDOW']) + ' in flight)' if 'WINDOW' in options else ''}")
+
+    session = None
+    packets_in = packets_out = 0
+    try:
+        session = TransferSession(filename, file_size, options, label)
+        for response_packet in session.initial_packets():
+            data_socket.sendto(response_packet, client_address)
+            packets_out += 1
+        request_buffer = bytearray(REQUEST_BUFFER_SIZE) # Reused for every request of this transfer
+        paced = PacedSender()
+        while not session.finished:
+            packets_out += paced.flush()
+            idle_deadline = session.last_activity + admission.idle_timeout
+            data_socket.settimeout(paced.timeout(idle_deadline))
+            # 1. Receive client's request for the next chunk
+            try:
+                # Reply to whoever sent the request: the client talks to the data port from its own
+                # data socket, not from the handshake socket that sent DOWNLOAD (already closed by then).
+                request_data, client_address = receive_packet(data_socket, request_buffer)
+                packets_in += 1
+                for response_packet in session.handle_packet(request_data):
+                    if paced.send(data_socket, response_packet, client_address):
+                        packets_out += 1
+            except socket.timeout:
+                if time.monotonic() < idle_deadline:
+                    continue # A held back packet is due
+                logger.warning(f"{label} No request for {admission.idle_timeout:g}s. Client might have disconnected; closing the session.")
+                admission.record_reaped()
+                break # Exit loop if client stops responding
+            except ValueError as e:
+                logger.warning(f"{label} Error parsing client request: {e}. Request was: {request_data[:80]}")
+                break
+            except Exception as e:
+                logger.error(f"{label} An unexpected error occurred during chunk transfer: {e}")
+                break
+        if session.finished:
+            packets_out += paced.drain() # The last chunk and CLOSE_OK may still be held back
 
     except FileNotFoundError:
         error_msg = f"ERR {filename} NOT_FOUND"
         data_socket.sendto(error_msg.encode('utf-8'), client_address)
-        print(f"[Thread {threading.get_ident()}] Error: File '{filename}' not found for transfer.")
+        logger.warning(f"{label} File '{filename}' not found for transfer.")
     except Exception as e:
-        print(f"[Thread {threading.get_ident()}] An error occurred while opening or reading file '{filename}': {e}")
+        logger.error(f"{label} An error occurred while opening or reading file '{filename}': {e}")
     finally:
+        if session is not None:
+            session.close()
         data_socket.close()
-        print(f"[Thread {threading.get_ident()}] Data socket for '{filename}' closed.")
+        admission.release()
+        if counters is not None:
+            counters.add(packets_in, packets_out)
+        logger.debug(f"{label} Data socket for '{filename}' closed.")
 
-# --- Main Server Logic ---
-def run_server(server_port):
-    ensure_dir(FILES_DIR) # Ensure the files directory exists
+# --- File Transfer Handler for all files of a DOWNLOAD_MANY (threaded engine) ---
+def handle_many_transfer(data_socket, sessions, counters=None):
+    """
+    Serves all sessions of one DOWNLOAD_MANY from a single data socket, dispatching binary REQs
+    by session id, until the client has closed every one of them with CLOSE_MANY.
+    This runs in a new thread for each batch, which holds one admission slot per session.
+    Sessions still open when the client sends nothing for the idle timeout are abandoned.
+    """
+    label = f"[Thread {threading.get_ident()}]"
+    sessions_by_id = {session.session_id: session for session in sessions}
+    logger.info(f"{label} Handling a batch of {len(sessions)} transfers via port {data_socket.getsockname()[1]}")
+    packets_in = packets_out = 0
+    request_buffer = bytearray(REQUEST_BUFFER_SIZE) # Reused for every request of this batch
+    paced = PacedSender()
+    idle_deadline = time.monotonic() + admission.idle_timeout
+    try:
+        while sessions_by_id:
+            packets_out += paced.flush()
+            data_socket.settimeout(paced.timeout(idle_deadline))
+            try:
+                request_data, client_address = receive_packet(data_socket, request_buffer)
+            except socket.timeout:
+                if time.monotonic() < idle_deadline:
+                    continue # A held back packet is due
+                raise
+            packets_in += 1
+            idle_deadline = time.monotonic() + admission.idle_timeout
+            if not request_data:
+                continue
+            responses = []
+            if request_data[0] == PACKET_MAGIC:
+                session = sessions_by_id.get(PACKET_HEADER.unpack_from(request_data)[3]) \
+                    if len(request_data) >= PACKET_HEADER.size else None
+                if session is not None:
+                    responses = session.handle_packet(request_data)
+            else:
+                session_ids = parse_close_many(request_data.decode('utf-8', errors='replace'))
+                if session_ids is None:
+                    logger.warning(f"{label} Received invalid request: {request_data[:80]}")
+                    continue
+                for session_id in session_ids:
+                    session = sessions_by_id.pop(session_id, None)
+                    if session is not None:
+                        session.closed_by_client = True
+                        session.finish()
+                        session.close()
+                responses = [b"CLOSE_MANY_OK"]
+            for response_packet in responses:
+                if paced.send(data_socket, response_packet, client_address):
+                    packets_out += 1
+        packets_out += paced.drain() # CLOSE_MANY_OK may still be held back behind DATA
+    except socket.timeout:
+        logger.warning(f"{label} No request for {admission.idle_timeout:g}s; closing {len(sessions_by_id)} sessions of the batch.")
+        admission.record_reaped(len(sessions_by_id))
+    except Exception as e:
+        logger.error(f"{label} An unexpected error occurred during batch transfer: {e}")
+    finally:
+        for session in sessions_by_id.values():
+            session.close()
+        data_socket.close()
+        admission.release(len(sessions))
+        if counters is not None:
+            counters.add(packets_in, packets_out)
+        logger.debug(f"{label} Data socket of the batch closed.")
+
+# --- Helper Function to size the kernel buffers of a socket ---
+def tune_socket_buffers(sock, size=SOCKET_BUFFER_SIZE):
+    """
+    Asks for large send and receive buffers, so bursts of large DATA datagrams are not dropped
+    in the kernel. Linux silently caps the request at net.core.wmem_max/rmem_max.
+    """
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, option, size)
+        except OSError as e:
+            logger.warning(f"Could not set socket buffer size: {e}")
 
+# --- Helper Function to bind the main server socket ---
+def bind_main_socket(server_port, reuse_port=False):
+    """
+    Binds the socket that receives DOWNLOAD requests. With reuse_port, several worker
+    processes bind the same port and the kernel spreads incoming handshakes across them.
+    """
     main_server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
+        if reuse_port:
+            main_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         main_server_socket.bind((SERVER_HOST, server_port))
-        print(f"UDP Server listening on {SERVER_HOST}:{server_port}")
+        logger.info(f"UDP Server listening on {SERVER_HOST}:{server_port}")
     except socket.error as e:
-        print(f"Error: Could not bind to port {server_port}. Reason: {e}")
-        print("Please check if the port is already in use or if you have sufficient permissions.")
+        logger.error(f"Could not bind to port {server_port}. Reason: {e}")
+        logger.error("Please check if the port is already in use or if you have sufficient permissions.")
         sys.exit(1) # Exit if cannot bind
+    return main_server_socket
+
+# --- Main Server Logic (threaded engine: one thread and one data socket per download) ---
+def run_server(server_port, reuse_port=False):
+    ensure_dir(FILES_DIR) # Ensure the files directory exists
+
+    main_server_socket = bind_main_socket(server_port, reuse_port)
+    counters = EngineCounters()
 
     while True:
         try:
             # Main socket listens for initial DOWNLOAD requests
-            data, client_address = main_server_socket.recvfrom(1024) # Small buffer for initial request
-            message = data.decode('utf-8').strip()
-            print(f"Received message from {client_address}: {message}")
-
-            parts = message.split()
-            if len(parts) == 2 and parts[0] == "DOWNLOAD":
-                filename = parts[1]
-                file_path = os.path.join(FILES_DIR, filename)
-
-                if os.path.exists(file_path) and os.path.isfile(file_path):
-                    file_size = os.path.getsize(file_path)
-                    
+            data, client_address = main_server_socket.recvfrom(REQUEST_BUFFER_SIZE)
+            counters.add(1, 0)
+            message = data.decode('utf-8', errors='replace').strip()
+            logger.debug(f"Received message from {client_address}: {message[:200]}")
+
+            download = lookup_download(message)
+            if message == "STATS":
+                main_server_socket.sendto(build_stats_response("threaded", counters), client_address)
+                counters.add(0, 1)
+
+            elif download is not None and download[1] is not None:
+                filename, file_size, requested_options = download
+                if not admission.admit():
+                    main_server_socket.sendto(build_busy_response(filename), client_address)
+                    counters.add(0, 1)
+                    logger.info(f"Sent BUSY for '{filename}' to {client_address}: {admission.max_sessions} sessions open.")
+                    continue
+
+                data_transfer_socket = None
+                try:
                     # Create a new UDP socket for this specific file transfer
                     data_transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
                     # Bind to an ephemeral (random available) port
-                    data_transfer_socket.bind((SERVER_HOST, 0)) 
+                    data_transfer_socket.bind((SERVER_HOST, 0))
                     data_port = data_transfer_socket.getsockname()[1] # Get the assigned port number
+                    tune_socket_buffers(data_transfer_socket)
 
                     # Send OK response to client
-                    ok_response = f"OK {filename} SIZE {file_size} PORT {data_port}"
-                    main_server_socket.sendto(ok_response.encode('utf-8'), client_address)
-                    print(f"Sent OK for '{filename}' (Size: {file_size}, Data Port: {data_port}) to {client_address}")
+                    options = negotiate_options(requested_options, filename)
+                    main_server_socket.sendto(build_ok_response(filename, file_size, data_port, options), client_address)
+                    counters.add(0, 1)
+                    logger.info(f"Sent OK for '{filename}' (Size: {file_size}, Data Port: {data_port}) to {client_address}")
 
                     # Start a new thread to handle the file transfer
                     # Pass the *new* data_transfer_socket to the thread
-                    thread = threading.Thread(target=handle_file_transfer, 
-                                              args=(data_transfer_socket, client_address, filename, file_size))
+                    thread = threading.Thread(target=handle_file_transfer,
+                                              args=(data_transfer_socket, client_address, filename, file_size, options, counters))
                     thread.daemon = True # Allow main program to exit even if threads are running
                     thread.start()
-                    print(f"Started new thread (ID: {thread.ident}) for '{filename}'.")
+                except Exception:
+                    # No thread took the transfer over, so nothing else gives back its slot and socket
+                    admission.release()
+                    if data_transfer_socket is not None:
+                        data_transfer_socket.close()
+                    raise
+                logger.debug(f"Started new thread (ID: {thread.ident}) for '{filename}'.")
 
-                else:
-                    error_response = f"ERR {filename} NOT_FOUND"
-                    main_server_socket.sendto(error_response.encode('utf-8'), client_address)
-                    print(f"Sent ERR NOT_FOUND for '{filename}' to {client_address}")
+            elif lookup_download_many(message) is not None:
+                requested_options, filenames = lookup_download_many(message)
+                # As many files as there are free slots; the client asks again for the rest
+                granted = admission.admit(len(filenames))
+                if granted == 0:
+                    main_server_socket.sendto(build_busy_response("DOWNLOAD_MANY"), client_address)
+                    counters.add(0, 1)
+                    logger.info(f"Sent BUSY for a batch of {len(filenames)} files to {client_address}.")
+                    continue
+                data_transfer_socket = None
+                sessions = []
+                try:
+                    # One data socket and one thread for the whole batch
+                    data_transfer_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    data_transfer_socket.bind((SERVER_HOST, 0))
+                    tune_socket_buffers(data_transfer_socket)
+                    reply, sessions = open_download_many(filenames[:granted], requested_options,
+                                                         data_transfer_socket.getsockname()[1], client_address)
+                    admission.release(granted - len(sessions)) # Inline and missing files need no session
+                    granted = len(sessions)
+                    main_server_socket.sendto(reply, client_address)
+                    counters.add(0, 1)
+                    if sessions:
+                        thread = threading.Thread(target=handle_many_transfer, args=(data_transfer_socket, sessions, counters))
+                        thread.daemon = True
+                        thread.start()
+                    else:
+                        # Everything was inline or missing; there is nothing to serve
+                        data_transfer_socket.close()
+                except Exception:
+                    # No thread took the batch over, so nothing else gives back its slots and socket
+                    admission.release(granted)
+                    for session in sessions:
+                        session.close()
+                    if data_transfer_socket is not None:
+                        data_transfer_socket.close()
+                    raise
+
+            elif download is not None:
+                filename = download[0]
+                error_response = f"ERR {filename} NOT_FOUND"
+                main_server_socket.sendto(error_response.encode('utf-8'), client_address)
+                counters.add(0, 1)
+                logger.info(f"Sent ERR NOT_FOUND for '{filename}' to {client_address}")
             else:
-                print(f"Received unknown command: {message} from {client_address}")
+                logger.warning(f"Received unknown command: {message[:80]} from {client_address}")
 
         except KeyboardInterrupt:
-            print("\nServer shutting down...")
+            logger.info("Server shutting down...")
             break
         except Exception as e:
-            print(f"An unexpected error occurred in main server loop: {e}")
+            logger.error(f"An unexpected error occurred in main server loop: {e}")
             # Continue listening or decide to break based on error severity
 
     main_server_socket.close()
-    print("Main server socket closed. Server gracefully stopped.")
+    counters.report("threaded")
+    logger.info("Main server socket closed. Server gracefully stopped.")
+
+# --- Main Server Logic (event-loop engine: every session multiplexed on the main socket) ---
+def run_server_eventloop(server_port, reuse_port=False):
+    """
+    Serves all downloads from a single thread and a single socket.
+    The OK reply names the main port as the data port, so chunk requests arrive on the same
+    socket as DOWNLOADs and are dispatched through a session table: binary packets by their
+    session id, text packets by the sending address. A session does not know its client's data
+    address until the first request, so it waits in `unclaimed` (keyed by client IP and filename)
+    until a request for that file arrives from a new address of that IP. Binary sessions wait
+    there too: their FILE CLOSE is text, and a session that never saw a binary REQ (an empty
+    file) could otherwise only be answered statelessly and would hold its slot until reaped.
+    Sessions idle for longer than the idle timeout are swept every REAP_INTERVAL seconds, and
+    packets the pacer holds back wait in a heap until they are due, so nothing ever sleeps.
+
+    When the main port is shared with other worker processes (reuse_port), the kernel may hand a
+    client's REQs to a different worker than the one holding its session, so each worker then
+    serves chunks from one private data socket instead and advertises that port.
+    """
+    ensure_dir(FILES_DIR) # Ensure the files directory exists
+    # Hashing a file stops every session of this loop, so only small files are hashed inline
+    file_cache.sync_limit = min(file_cache.sync_limit, EVENTLOOP_DIGEST_SYNC_LIMIT)
+
+    main_server_socket = bind_main_socket(server_port, reuse_port)
+    main_server_socket.setblocking(False)
+    if reuse_port:
+        data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        data_socket.bind((SERVER_HOST, 0))
+        data_socket.setblocking(False)
+    else:
+        data_socket = main_server_socket
+    # One socket carries the DATA of every session
+    tune_socket_buffers(data_socket)
+    data_port = data_socket.getsockname()[1]
+    selector = selectors.DefaultSelector()
+    selector.register(main_server_socket, selectors.EVENT_READ)
+    if data_socket is not main_server_socket:
+        selector.register(data_socket, selectors.EVENT_READ)
+    counters = EngineCounters()
+
+    request_buffer = bytearray(REQUEST_BUFFER_SIZE) # Every packet is received into this one buffer
+    sessions_by_id = {}        # binary session id -> TransferSession
+    sessions_by_address = {}   # client data address -> TransferSession (text format)
+    unclaimed = {}             # (client IP, filename) -> [TransferSession, ...] (no request yet)
+    unclaimed_keys = {}        # TransferSession -> its key in unclaimed
+    open_sessions = set()      # Every session holding an admission slot, whichever table it is in
+    paced = PacedSender()      # Holds back packets the pacer delays, so nothing ever sleeps
+
+    def unclaim(session):
+        key = unclaimed_keys.pop(session, None)
+        if key is not None:
+            waiting = unclaimed[key]
+            waiting.remove(session)
+            if not waiting:
+                del unclaimed[key]
+
+    def claim(session, client_address):
+        """Binds a session to the data address its requests come from."""
+        unclaim(session)
+        session.client_address = client_address
+        sessions_by_address.setdefault(client_address, session)
+
+    def end_session(session):
+        if session not in open_sessions:
+            return # Already ended
+        open_sessions.discard(session)
+        admission.release()
+        session.close()
+        sessions_by_id.pop(session.session_id, None)
+        unclaim(session)
+        if sessions_by_address.get(session.client_address) is session:
+            del sessions_by_address[session.client_address]
+
+    def handle_download(message, client_address):
+        download = lookup_download(message)
+        if download is None:
+            logger.warning(f"Received unknown command: {message[:80]} from {client_address}")
+            return []
+        filename, file_size, requested_options = download
+        if file_size is None:
+            logger.info(f"Sent ERR NOT_FOUND for '{filename}' to {client_address}")
+            return [f"ERR {filename} NOT_FOUND".encode('utf-8')]
+
+        if not admission.admit():
+            logger.info(f"Sent BUSY for '{filename}' to {client_address}: {admission.max_sessions} sessions open.")
+            return [build_busy_response(filename)]
+
+        try:
+            options = negotiate_options(requested_options, filename)
+            session = TransferSession(filename, file_size, options, f"[Session {filename}@{client_address[0]}]")
+        except FileNotFoundError:
+            admission.release()
+            return [f"ERR {filename} NOT_FOUND".encode('utf-8')]
+        except Exception:
+            admission.release()
+            raise
+        open_sessions.add(session) # From here on end_session() gives back the slot
+        try:
+            responses = [build_ok_response(filename, file_size, data_port, options)] + session.initial_packets()
+        except Exception:
+            end_session(session)
+            raise
+        logger.info(f"Sent OK for '{filename}' (Size: {file_size}, Data Port: {data_port}) to {client_address}")
+        if file_size == 0:
+            # Nothing to serve: a windowed client only sends its FILE CLOSE, answered statelessly
+            session.finished = True
+        if session.finished:
+            end_session(session)
+            return responses
+        if session.session_id is not None:
+            sessions_by_id[session.session_id] = session
+        unclaimed_keys[session] = (client_address[0], filename)
+        unclaimed.setdefault(unclaimed_keys[session], []).append(session)
+        return responses
+
+    def find_session(data, client_address):
+        if data[0] == PACKET_MAGIC:
+            if len(data) < PACKET_HEADER.size:
+                return None
+            session = sessions_by_id.get(PACKET_HEADER.unpack_from(data)[3])
+            if session is not None and session.client_address is None:
+                # The text FILE CLOSE of a binary session is matched by this address
+                claim(session, client_address)
+            return session
+        session = sessions_by_address.get(client_address)
+        if session is None:
+            parts = data.split(None, 2)
+            waiting = unclaimed.get((client_address[0], parts[1].decode('utf-8', errors='replace'))) if len(parts) > 1 else None
+            if waiting:
+                # A binary session sends nothing but its FILE CLOSE as text
+                closing = data.rstrip().endswith(b" CLOSE")
+                session = next((candidate for candidate in waiting if closing or candidate.session_id is None), None)
+                if session is not None:
+                    claim(session, client_address)
+        return session
+
+    def handle_download_many(message, client_address):
+        requested_options, filenames = lookup_download_many(message)
+        # As many files as there are free slots; the client asks again for the rest
+        granted = admission.admit(len(filenames))
+        if granted == 0:
+            logger.info(f"Sent BUSY for a batch of {len(filenames)} files to {client_address}.")
+            return [build_busy_response("DOWNLOAD_MANY")]
+        try:
+            reply, sessions = open_download_many(filenames[:granted], requested_options, data_port, client_address)
+        except Exception:
+            admission.release(granted)
+            raise
+        admission.release(granted - len(sessions)) # Inline and missing files need no session
+        for session in sessions:
+            sessions_by_id[session.session_id] = session
+            open_sessions.add(session)
+        return [reply]
+
+    def handle_close_many(session_ids):
+        for session_id in session_ids:
+            session = sessions_by_id.get(session_id)
+            if session is not None:
+                session.closed_by_client = True
+                session.finish()
+                end_session(session)
+        # Ids we do not know were closed before (our CLOSE_MANY_OK got lost)
+        return [b"CLOSE_MANY_OK"]
+
+    def dispatch(data, client_address):
+        # Binary packets arrive as memoryviews, text messages as bytes (see receive_packet)
+        is_text = isinstance(data, bytes)
+        if is_text and data.startswith(b"DOWNLOAD "):
+            return handle_download(data.decode('utf-8', errors='replace').strip(), client_address)
+        if is_text and data.startswith(b"DOWNLOAD_MANY "):
+            message = data.decode('utf-8', errors='replace').strip()
+            if lookup_download_many(message) is None:
+                logger.warning(f"Received malformed DOWNLOAD_MANY from {client_address}")
+                return []
+            return handle_download_many(message, client_address)
+        if is_text and data.startswith(b"CLOSE_MANY "):
+            session_ids = parse_close_many(data.decode('utf-8', errors='replace'))
+            return handle_close_many(session_ids) if session_ids is not None else []
+        if is_text and data.strip() == b"STATS":
+            return [build_stats_response("eventloop", counters)]
+
+        session = find_session(data, client_address)
+        if session is None:
+            if is_text and data.startswith(b"FILE ") and data.rstrip().endswith(b" CLOSE"):
+                # The session already ended and our CLOSE_OK was lost; closing is idempotent
+                return [data.rstrip() + b"_OK"]
+            logger.debug(f"Received packet for unknown session from {client_address}: {bytes(data[:80])}")
+            return []
+        try:
+            responses = session.handle_packet(data)
+        except ValueError as e:
+            logger.warning(f"{session.label} Error parsing client request: {e}. Request was: {data[:80]}")
+            end_session(session)
+            return []
+        if session.finished:
+            end_session(session)
+        return responses
+
+    def reap_idle_sessions():
+        cutoff = time.monotonic() - admission.idle_timeout
+        idle = [session for session in open_sessions if session.last_activity < cutoff]
+        for session in idle:
+            logger.warning(f"{session.label} No request for {admission.idle_timeout:g}s. Client might have disconnected; closing the session.")
+            end_session(session)
+        if idle:
+            admission.record_reaped(len(idle))
+
+    next_reap = time.monotonic() + REAP_INTERVAL
+    while True:
+        try:
+            for key, _events in selector.select(paced.timeout(next_reap)):
+                ready_socket = key.fileobj
+                # Drain everything that is queued before going back to select()
+                while True:
+                    try:
+                        data, client_address = receive_packet(ready_socket, request_buffer)
+                    except BlockingIOError:
+                        break
+                    counters.add(1, 0)
+                    if not data:
+                        continue
+                    for response_packet in dispatch(data, client_address):
+                        if paced.send(ready_socket, response_packet, client_address):
+                            counters.add(0, 1)
+
+            counters.add(0, paced.flush())
+            now = time.monotonic()
+            if now >= next_reap:
+                reap_idle_sessions()
+                next_reap = now + REAP_INTERVAL
+
+        except KeyboardInterrupt:
+            logger.info("Server shutting down...")
+            break
+        except Exception as e:
+            logger.error(f"An unexpected error occurred in main server loop: {e}")
+
+    for session in open_sessions:
+        session.close()
+    selector.close()
+    if data_socket is not main_server_socket:
+        data_socket.close()
+    main_server_socket.close()
+    counters.report("eventloop")
+    logger.info("Main server socket closed. Server gracefully stopped.")
+
+SERVER_ENGINES = {
+    'threaded': run_server,
+    'eventloop': run_server_eventloop,
+}
+
+# --- Worker process entry point (multi-process mode) ---
+def run_worker(server_port, engine):
+    # Ctrl+C reaches the whole process group; make sure it stops workers gracefully
+    # even if the supervisor was started with SIGINT ignored (e.g. in the background)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    logger.info(f"Worker {os.getpid()} starting ({engine} engine).")
+    SERVER_ENGINES[engine](server_port, reuse_port=True)
+
+# --- Supervisor for multi-process mode ---
+def run_workers(server_port, engine, worker_count):
+    """
+    Forks `worker_count` worker processes that all bind the main port with SO_REUSEPORT,
+    so the kernel spreads DOWNLOAD handshakes across them. Every worker owns its data sockets
+    and sessions. Workers that exit with an error are restarted; Ctrl+C or SIGTERM stops all.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        logger.error("--workers needs SO_REUSEPORT, which this platform does not provide.")
+        sys.exit(1)
+    # Fail fast (instead of restarting workers forever) if the port cannot be bound at all.
+    # The probe socket is closed again so the kernel never routes packets to the supervisor.
+    bind_main_socket(server_port, reuse_port=True).close()
+
+    context = multiprocessing.get_context('fork')
+    workers = {}    # sentinel -> (slot, process, start time)
+
+    def start_worker(slot):
+        process = context.Process(target=run_worker, args=(server_port, engine), name=f"udp-worker-{slot}")
+        process.start()
+        workers[process.sentinel] = (slot, process, time.monotonic())
+
+    def stop_on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    for slot in range(worker_count):
+        start_worker(slot)
+    logger.info(f"Supervisor {os.getpid()} running {worker_count} workers on port {server_port}.")
+
+    try:
+        while workers:
+            for sentinel in wait_for_processes(list(workers)):
+                slot, process, started = workers.pop(sentinel)
+                process.join()
+                if process.exitcode == 0:
+                    logger.info(f"Worker {process.pid} (slot {slot}) exited.")
+                    continue
+                logger.warning(f"Worker {process.pid} (slot {slot}) died with exit code {process.exitcode}. Restarting.")
+                if time.monotonic() - started < WORKER_MIN_UPTIME:
+                    time.sleep(WORKER_RESTART_DELAY) # Don't spin if it crashes right away
+                start_worker(slot)
+    except KeyboardInterrupt:
+        logger.info("Supervisor shutting down workers...")
+        for _slot, process, _started in workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for _slot, process, _started in workers.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+    logger.info("Supervisor stopped.")
 
 # --- Entry Point ---
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python3 UDPServer.py <port_number>")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(prog="UDPServer.py", description="Serve the files in the files/ directory over UDP.")
+    parser.add_argument("port_number")
+    parser.add_argument("--engine", choices=sorted(SERVER_ENGINES), default='threaded',
+                        help="threaded: one thread and data socket per download (default); "
+                             "eventloop: all sessions multiplexed on the main socket by a single thread")
+    parser.add_argument("--cache-mb", type=int, default=CACHE_BUDGET_MB,
+                        help=f"memory budget for memory-mapped hot files, 0 disables mapping (default {CACHE_BUDGET_MB})")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes sharing the port via SO_REUSEPORT (default 1: no workers)")
+    parser.add_argument("--max-sessions", type=int, default=MAX_SESSIONS,
+                        help=f"transfer sessions open at once per process; further DOWNLOADs are answered BUSY "
+                             f"(default {MAX_SESSIONS}, 0 for no cap)")
+    parser.add_argument("--idle-timeout", type=float, default=SESSION_IDLE_TIMEOUT,
+                        help=f"close a session after this many seconds without a packet from its client (default {SESSION_IDLE_TIMEOUT:g})")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="total send rate of DATA per process in Mbit/s (default 0: unlimited)")
+    parser.add_argument("--client-rate-limit", type=float, default=0,
+                        help="send rate of DATA to each client IP in Mbit/s (default 0: unlimited)")
+    parser.add_argument("--log-level", choices=['debug', 'info', 'warning', 'error'], default='info',
+                        help="debug also logs every chunk sent, which slows transfers down (default info)")
+    parser.add_argument("--log-rate", type=int, default=LOG_RATE,
+                        help=f"max log lines per second from one place in the code, 0 for no limit (default {LOG_RATE})")
+    args = parser.parse_args()
     
     try:
-        port = int(sys.argv[1])
+        port = int(args.port_number)
         if not (1024 <= port <= 65535): # Standard port range
             raise ValueError("Port number must be between 1024 and 65535.")
     except ValueError as e:
         print(f"Error: Invalid port number. {e}")
         sys.exit(1)
+    if args.workers < 1:
+        print("Error: --workers must be at least 1.")
+        sys.exit(1)
+    if args.idle_timeout <= 0:
+        print("Error: --idle-timeout must be positive.")
+        sys.exit(1)
+    file_cache.byte_budget = max(args.cache_mb, 0) * 1024 * 1024
+    admission = AdmissionControl(max(args.max_sessions, 0), args.idle_timeout)
+    pacer = Pacer(max(args.rate_limit, 0) * 1e6 / 8, max(args.client_rate_limit, 0) * 1e6 / 8)
+    configure_logging(args.log_level, args.log_rate)
 
-    run_server(port)
-
+    if args.workers > 1:
+        run_workers(port, args.engine, args.workers)
+    else:
+        SERVER_ENGINES[args.engine](port)
@@ -0,0 +1,371 @@
+import argparse
+import heapq
+import json
+import math
+import os
+import platform
+import random
+import re
+import selectors
+import shlex
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# --- Configuration ---
+HERE = os.path.dirname(os.path.abspath(__file__))
+SERVER_SCRIPT = os.path.join(HERE, 'UDPserver.py')
+CLIENT_SCRIPT = os.path.join(HERE, 'UDPclient.py')
+PROXY_BUFFER_SIZE = 65536  # recvfrom() size, enough for any UDP datagram
+SERVER_START_TIMEOUT = 10.0 # How long to wait for a freshly started server to answer STATS (seconds)
+CLIENT_TIMEOUT = 300.0     # Default limit for one client process (seconds)
+REORDER_DELAY = 0.005      # Extra delay of a reordered datagram, so later ones overtake it (seconds)
+FILE_BLOCK_SIZE = 1024 * 1024 # Write size when generating test files
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# --- Lossy link emulator ---
+class LossyLink:
+    """
+    A UDP proxy on loopback that impairs every datagram it forwards, in both directions: it drops
+    it with probability `loss`, delays it by `delay` plus up to `jitter` seconds, sends it twice
+    with probability `duplicate`, and holds it back an extra REORDER_DELAY with probability
+    `reorder` so that later datagrams overtake it.
+
+    Clients talk to `port`, which forwards to the server's main port. The data port in OK and
+    OK_MANY replies is rewritten to a proxy port forwarding to it, so the chunk traffic crosses
+    the emulated link too. Runs in its own thread until stop() is called.
+    """
+
+    def __init__(self, server_port, loss=0.0, delay=0.0, jitter=0.0, duplicate=0.0, reorder=0.0, seed=None):
+        self.server_port = server_port
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.fronts = {}    # server port -> socket clients send to
+        self.uplinks = {}   # (server port, client address) -> socket that talks to the server
+        self.queue = []     # (due time, sequence, socket, datagram, address)
+        self.sequence = 0
+        self.forwarded = 0
+        self.dropped = 0
+        self.running = True
+        self.port = self._front(server_port).getsockname()[1]
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        for sock in list(self.fronts.values()) + list(self.uplinks.values()):
+            sock.close()
+        self.selector.close()
+
+    def _front(self, server_port):
+        sock = self.fronts.get(server_port)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            sock.setblocking(False)
+            self.fronts[server_port] = sock
+            self.selector.register(sock, selectors.EVENT_READ, ('front', server_port))
+        return sock
+
+    def _schedule(self, sock, datagram, address):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        copies = 2 if self.random.random() < self.duplicate else 1
+        for _ in range(copies):
+            due = time.monotonic() + self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                due += REORDER_DELAY
+            self.sequence += 1
+            heapq.heappush(self.queue, (due, self.sequence, sock, datagram, address))
+
+    def _rewrite_port(self, datagram):
+        # "OK <file> SIZE <n> PORT <p> ..." and "OK_MANY PORT <p> ..." name the data port
+        match = re.match(rb'(OK \S+ SIZE \d+ PORT |OK_MANY PORT )(\d+)(.*)', datagram, re.S)
+        if match is None:
+            return datagram
+        front_port = self._front(int(match.group(2))).getsockname()[1]
+        return match.group(1) + str(front_port).encode('utf-8') + match.group(3)
+
+    def _run(self):
+        while self.running:
+            timeout = 0.05
+            if self.queue:
+                timeout = min(max(self.queue[0][0] - time.monotonic(), 0), timeout)
+            for key, _events in self.selector.select(timeout):
+                kind, info = key.data
+                while True:
+                    try:
+                        datagram, address = key.fileobj.recvfrom(PROXY_BUFFER_SIZE)
+                    except BlockingIOError:
+                        break
+                    if kind == 'front':
+                        uplink = self.uplinks.get((info, address))
+                        if uplink is None:
+                            uplink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                            uplink.bind(('127.0.0.1', 0))
+                            uplink.setblocking(False)
+                            self.uplinks[(info, address)] = uplink
+                            self.selector.register(uplink, selectors.EVENT_READ, ('uplink', (info, address)))
+                        self._schedule(uplink, datagram, ('127.0.0.1', info))
+                    else:
+                        server_port, client_address = info
+                        self._schedule(self.fronts[server_port], self._rewrite_port(datagram), client_address)
+            now = time.monotonic()
+            while self.queue and self.queue[0][0] <= now:
+                _due, _sequence, sock, datagram, address = heapq.heappop(self.queue)
+                try:
+                    sock.sendto(datagram, address)
+                    self.forwarded += 1
+                except OSError:
+                    self.dropped += 1
+
+# --- Helpers for the server process ---
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def query_stats(port, timeout=0.5):
+    """Sends STATS to the server's main port. Returns the decoded reply, or None if it did not answer."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(b"STATS", ('127.0.0.1', port))
+            reply, _ = sock.recvfrom(PROXY_BUFFER_SIZE)
+        except OSError:
+            return None
+    if not reply.startswith(b"STATS "):
+        return None
+    return json.loads(reply[len(b"STATS "):])
+
+def start_server(work_dir, server_args):
+    """Starts UDPserver.py serving work_dir/files and waits until it answers STATS. Returns (process, port)."""
+    port = free_port()
+    log_file = open(os.path.join(work_dir, 'server.log'), 'w')
+    # Ctrl+C handling needs SIGINT at its default, even when the benchmark itself runs in the background
+    process = subprocess.Popen([sys.executable, SERVER_SCRIPT, str(port)] + server_args, cwd=work_dir,
+                               stdout=log_file, stderr=subprocess.STDOUT,
+                               preexec_fn=lambda: signal.signal(signal.SIGINT, signal.SIG_DFL))
+    log_file.close()
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while query_stats(port) is None:
+        if process.poll() is not None or time.monotonic() > deadline:
+            stop_server(process)
+            raise RuntimeError(f"server did not start; see {os.path.join(work_dir, 'server.log')}")
+        time.sleep(0.1)
+    return process, port
+
+def stop_server(process):
+    """Stops the server with Ctrl+C and returns its resource usage: CPU seconds and peak RSS."""
+    if process.poll() is None:
+        process.send_signal(signal.SIGINT)
+    try:
+        _pid, _status, usage = os.wait4(process.pid, 0)
+    except ChildProcessError:
+        return None
+    process.returncode = 0 # Reaped by wait4(); keep Popen from waiting again
+    # ru_maxrss is reported in kilobytes on Linux
+    return {'cpu_user_s': round(usage.ru_utime, 3), 'cpu_system_s': round(usage.ru_stime, 3),
+            'peak_rss_kb': usage.ru_maxrss}
+
+# --- Helpers for test files and sizes ---
+def parse_size(text):
+    """Turns '100K', '10M' or '1G' into a byte count."""
+    match = re.fullmatch(r'(\d+)([KMG]?)', text.strip().upper())
+    if match is None:
+        raise argparse.ArgumentTypeError(f"invalid size '{text}'")
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+def make_test_file(files_dir, size, seed):
+    """Creates files/bench_<size>.bin with reproducible random content, unless it exists. Returns its name."""
+    filename = f"bench_{size}.bin"
+    path = os.path.join(files_dir, filename)
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        generator = random.Random(seed + size)
+        with open(path, 'wb') as f:
+            for offset in range(0, size, FILE_BLOCK_SIZE):
+                f.write(generator.randbytes(min(FILE_BLOCK_SIZE, size - offset)))
+    return filename
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of `values`, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)), 1) - 1]
+
+# --- One cell of the matrix ---
+def run_cell(work_dir, filename, size, concurrency, loss, args):
+    """
+    Starts a fresh server and proxy, runs `concurrency` client processes that each download the
+    file at the same time, `args.repeat` times, and returns the measurements of the cell.
+    """
+    server, server_port = start_server(work_dir, shlex.split(args.server_args))
+    link = LossyLink(server_port, loss, args.delay / 1000, args.jitter / 1000, args.duplicate, args.reorder, args.seed)
+    completion_times = []
+    statuses = {}
+    delivered = 0
+    totals = {'requests_sent': 0, 'retransmits': 0, 'crc_errors': 0, 'duplicates': 0}
+    elapsed = 0.0
+    try:
+        for _repetition in range(args.repeat):
+            clients = []
+            for index in range(concurrency):
+                client_dir = os.path.join(work_dir, f"client_{index}")
+                shutil.rmtree(client_dir, ignore_errors=True)
+                os.makedirs(client_dir)
+                with open(os.path.join(client_dir, 'list.txt'), 'w') as list_file:
+                    list_file.write(filename + '\n')
+                command = [sys.executable, CLIENT_SCRIPT, '127.0.0.1', str(link.port), 'list.txt',
+                           '--stats-json', 'stats.json', '--log-level', 'warning'] + shlex.split(args.client_args)
+                log_file = open(os.path.join(client_dir, 'client.log'), 'w')
+                clients.append((client_dir, subprocess.Popen(command, cwd=client_dir, stdout=log_file, stderr=subprocess.STDOUT)))
+                log_file.close()
+            started = time.monotonic()
+            for client_dir, process in clients:
+                try:
+                    process.wait(timeout=max(args.timeout - (time.monotonic() - started), 0.1))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+                    statuses['timeout'] = statuses.get('timeout', 0) + 1
+                    continue
+                try:
+                    with open(os.path.join(client_dir, 'stats.json')) as stats_file:
+                        stats = json.load(stats_file)
+                except (OSError, ValueError):
+                    statuses['crashed'] = statuses.get('crashed', 0) + 1
+                    continue
+                for key in totals:
+                    totals[key] += stats['totals'][key]
+                for result in stats['results']:
+                    statuses[result['status']] = statuses.get(result['status'], 0) + 1
+                    if result['status'] == 'ok':
+                        delivered += result['bytes']
+                        completion_times.append(result['seconds'])
+            elapsed += time.monotonic() - started
+        server_stats = query_stats(server_port)
+    finally:
+        link.stop()
+        usage = stop_server(server)
+
+    transfers = concurrency * args.repeat
+    p50, p99 = percentile(completion_times, 0.50), percentile(completion_times, 0.99)
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'loss': loss,
+        'transfers': transfers,
+        'statuses': statuses,
+        'elapsed_s': round(elapsed, 3),
+        'goodput_mbps': round(delivered * 8 / max(elapsed, 1e-9) / 1e6, 3),
+        'completion_p50_s': round(p50, 4) if p50 is not None else None,
+        'completion_p99_s': round(p99, 4) if p99 is not None else None,
+        'retransmit_ratio': round(totals['retransmits'] / totals['requests_sent'], 4) if totals['requests_sent'] else None,
+        'client_totals': totals,
+        'server_totals': server_stats['totals'] if server_stats is not None else None,
+        'server_usage': usage,
+        'link': {'forwarded': link.forwarded, 'dropped': link.dropped},
+    }
+
+# --- Comparison with an earlier run ---
+def compare(results, baseline_path):
+    """Prints the change in goodput and p99 completion time against the cells of an earlier results file."""
+    with open(baseline_path) as baseline_file:
+        baseline = {(cell['size'], cell['concurrency'], cell['loss']): cell for cell in json.load(baseline_file)['results']}
+    print(f"\n--- Compared with {baseline_path} ---")
+    for cell in results:
+        old = baseline.get((cell['size'], cell['concurrency'], cell['loss']))
+        if old is None:
+            continue
+        changes = []
+        for key in ('goodput_mbps', 'completion_p99_s'):
+            if old[key] and cell[key] is not None:
+                changes.append(f"{key} {(cell[key] - old[key]) / old[key] * 100:+.1f}%")
+        print(f"size {cell['size']:>11} x{cell['concurrency']:<3} loss {cell['loss']:<5} " + ', '.join(changes))
+
+def print_table(results):
+    print(f"\n{'size':>11} {'conc':>4} {'loss':>6} {'goodput Mb/s':>13} {'p50 s':>8} {'p99 s':>8} {'retx':>7} "
+          f"{'srv cpu s':>9} {'srv rss KB':>10}  statuses")
+    for cell in results:
+        usage = cell['server_usage'] or {}
+        cpu = usage.get('cpu_user_s', 0) + usage.get('cpu_system_s', 0)
+        p50 = '-' if cell['completion_p50_s'] is None else f"{cell['completion_p50_s']:.3f}"
+        p99 = '-' if cell['completion_p99_s'] is None else f"{cell['completion_p99_s']:.3f}"
+        retx = '-' if cell['retransmit_ratio'] is None else f"{cell['retransmit_ratio']:.4f}"
+        print(f"{cell['size']:>11} {cell['concurrency']:>4} {cell['loss']:>6} {cell['goodput_mbps']:>13.2f} {p50:>8} {p99:>8} "
+              f"{retx:>7} {cpu:>9.2f} {usage.get('peak_rss_kb', 0):>10}  {cell['statuses']}")
+
+# --- Entry Point ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="benchmark.py",
+                                     description="Benchmark UDPserver.py and UDPclient.py on loopback through an emulated lossy link.")
+    parser.add_argument("--sizes", type=lambda text: [parse_size(size) for size in text.split(',')], default=[parse_size('1M')],
+                        help="comma-separated file sizes, with K, M or G suffixes (default 1M)")
+    parser.add_argument("--concurrency", type=lambda text: [int(count) for count in text.split(',')], default=[1],
+                        help="comma-separated numbers of clients downloading at the same time (default 1)")
+    parser.add_argument("--loss", type=lambda text: [float(rate) for rate in text.split(',')], default=[0.0],
+                        help="comma-separated loss probabilities per datagram and direction (default 0)")
+    parser.add_argument("--delay", type=float, default=0.0, help="one-way delay added by the link, in ms (default 0)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="up to this many ms of extra random delay (default 0)")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability that a datagram is delivered twice (default 0)")
+    parser.add_argument("--reorder", type=float, default=0.0,
+                        help=f"probability that a datagram is held back {REORDER_DELAY * 1000:g} ms and overtaken (default 0)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs of every cell; all transfers count toward the percentiles (default 1)")
+    parser.add_argument("--server-args", default="", help="extra arguments for UDPserver.py, e.g. --server-args=\"--engine eventloop\"")
+    parser.add_argument("--client-args", default="", help="extra arguments for UDPclient.py, e.g. --client-args=\"--window 64\"")
+    parser.add_argument("--timeout", type=float, default=CLIENT_TIMEOUT,
+                        help=f"seconds a run of one cell may take before its clients are killed (default {CLIENT_TIMEOUT:g})")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the test file contents and the link's randomness (default 1)")
+    parser.add_argument("--work-dir", help="directory for test files and logs (default: a temporary directory, removed afterwards)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results file of an earlier run to compare goodput and p99 against")
+    args = parser.parse_args()
+
+    started_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='udp-bench-')
+    files_dir = os.path.join(work_dir, 'files')
+    os.makedirs(files_dir, exist_ok=True)
+    results = []
+    try:
+        for size in args.sizes:
+            filename = make_test_file(files_dir, size, args.seed)
+            for concurrency in args.concurrency:
+                for loss in args.loss:
+                    print(f"Running size {size}, {concurrency} clients, loss {loss}...", flush=True)
+                    results.append(run_cell(work_dir, filename, size, concurrency, loss, args))
+    except KeyboardInterrupt:
+        print("Interrupted; reporting the cells that completed.")
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+    report = {
+        'meta': {
+            'started': started_at,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'work_dir')},
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+        print(f"\nWrote results to '{args.output}'.")
+    if args.baseline:
+        compare(results, args.baseline)